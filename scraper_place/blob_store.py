@@ -0,0 +1,105 @@
+"""blob_store: Store each downloaded file once per content
+
+A file is stored as a blob named after its sha256 in blob_directory, and its public filename (see
+build_internal_filepath()) is a hard link to the blob. The web server and the stages keep using the public filenames,
+while the identical reglements, avis and complements published under several annonces share their disk space.
+Use sweep() once the downloads are over to remove the blobs no public filename uses anymore.
+"""
+
+import errno
+import logging
+import os
+import time
+
+from scraper_place import metrics
+from scraper_place.config import CONFIG_FILE_STORAGE
+
+
+def build_blob_filepath(digest):
+    # Spread over 256 directories, a single directory would hold hundreds of thousands of blobs
+    return os.path.join(CONFIG_FILE_STORAGE['blob_directory'], digest[:2], digest)
+
+
+def commit_file(file_path, digest, public_filepath):
+    """commit_file: Move a complete file into the blob store, and link public_filepath to its blob
+
+    file_path: file in blob_directory (see download), removed if a blob with the same content already exists
+    digest: sha256 of the file
+    """
+
+    size = os.path.getsize(file_path)
+    blob_filepath = build_blob_filepath(digest)
+    os.makedirs(os.path.dirname(blob_filepath), exist_ok=True)
+    if os.path.exists(blob_filepath):
+        os.remove(file_path)
+        metrics.count('fetch_blobs_deduplicated')
+        metrics.count('fetch_bytes_deduplicated', size)
+    else:
+        # Two workers storing the same content replace the blob with identical bytes
+        os.replace(file_path, blob_filepath)
+
+    link_public_filepath(blob_filepath, public_filepath)
+
+
+def link_public_filepath(blob_filepath, public_filepath):
+    """link_public_filepath: Make public_filepath a hard link to the blob, replacing the previous file if any
+
+    Falls back to a symbolic link if blob_directory is on another filesystem or the blob has too many links.
+    """
+
+    temporary_path = public_filepath + '.link'
+    if os.path.lexists(temporary_path):
+        os.remove(temporary_path)
+    try:
+        os.link(blob_filepath, temporary_path)
+    except OSError as exception:
+        if exception.errno not in (errno.EXDEV, errno.EMLINK):
+            raise
+        os.symlink(os.path.abspath(blob_filepath), temporary_path)
+    os.replace(temporary_path, public_filepath)
+
+
+def sweep(max_unused_days):
+    """sweep: Remove the blobs no public filename links to anymore, and the part files of abandoned downloads
+
+    A DCE fetched again (see fetch.check_link()) links its public filenames to the blobs of the new version, the blobs of
+    the previous version are then only linked from blob_directory. The files modified in the last max_unused_days are
+    kept: a part file may be resumed by the next run.
+    Returns the number of files and of bytes removed.
+    """
+
+    blob_directory = CONFIG_FILE_STORAGE['blob_directory']
+    limit = time.time() - max_unused_days * 86400
+    # The blobs reached through the symbolic link fallback of link_public_filepath()
+    symlinked_blobs = {
+        os.path.realpath(dir_entry.path)
+        for dir_entry in os.scandir(CONFIG_FILE_STORAGE['public_directory'])
+        if dir_entry.is_symlink()
+    }
+
+    nb_files = 0
+    nb_bytes = 0
+    for dirpath, _, filenames in os.walk(blob_directory):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime > limit:
+                continue
+            if dirpath == blob_directory:
+                # The part files, see download.build_part_filepath()
+                unused = filename.endswith('.part') or filename.endswith('.part.json')
+            else:
+                unused = stat.st_nlink == 1 and os.path.realpath(file_path) not in symlinked_blobs
+            if not unused:
+                continue
+            os.remove(file_path)
+            nb_files += 1
+            nb_bytes += stat.st_size
+            logging.debug('Removed {} from the blob store'.format(file_path))
+
+    metrics.count('fetch_blob_store_files_removed', nb_files)
+    metrics.count('fetch_blob_store_bytes_removed', nb_bytes)
+    return nb_files, nb_bytes
@@ -5,6 +5,9 @@ import os
 import logging
 import logging.handlers
 
+import boto3
+from boto3.s3.transfer import TransferConfig
+
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 #base_dir = os.getcwd()  # notebook
@@ -16,9 +19,13 @@ CONFIG.read(CONFIG_PATH)
 
 CONFIG_ENV = dict(CONFIG.items('env'))
 CONFIG_FILE_STORAGE = dict(CONFIG.items('file_storage'))
+CONFIG_FETCH = dict(CONFIG.items('fetch'))
 CONFIG_S3 = dict(CONFIG.items('s3'))
 CONFIG_TIKA = dict(CONFIG.items('tika'))
 CONFIG_ELASTICSEARCH = dict(CONFIG.items('elasticsearch'))
+CONFIG_PIPELINE = dict(CONFIG.items('pipeline'))
+CONFIG_BACKUP = dict(CONFIG.items('backup'))
+CONFIG_METRICS = dict(CONFIG.items('metrics'))
 
 
 # Possible values for the processing state
@@ -46,6 +53,36 @@ def build_internal_filepath(annonce_id, original_filename, file_type):
 def build_extract_filepath(annonce_id):
     return os.path.join(CONFIG_FILE_STORAGE['extract_output_dir'], '{}.txt.gz'.format(annonce_id))
 
+def build_s3_session():
+    return boto3.session.Session(
+        aws_access_key_id=CONFIG_S3['aws_access_key_id'],
+        aws_secret_access_key=CONFIG_S3['aws_secret_access_key'],
+        region_name=CONFIG_S3['region_name'],
+    )
+
+def build_s3_resource():
+    """build_s3_resource: build a S3 resource from the [s3] config
+
+    boto3 resources are not thread safe, build one per thread.
+    """
+    return build_s3_session().resource('s3', endpoint_url=CONFIG_S3['endpoint_url'] or None)
+
+def build_s3_client():
+    """build_s3_client: build a S3 client from the [s3] config
+
+    boto3 clients are thread safe, one client can be shared by all the upload workers.
+    """
+    return build_s3_session().client('s3', endpoint_url=CONFIG_S3['endpoint_url'] or None)
+
+def build_transfer_config():
+    """build_transfer_config: build the multipart settings of the S3 uploads from the [s3] config
+    """
+    return TransferConfig(
+        multipart_threshold=int(float(CONFIG_S3['multipart_threshold_mb']) * 1048576),
+        multipart_chunksize=int(float(CONFIG_S3['multipart_chunksize_mb']) * 1048576),
+        max_concurrency=int(CONFIG_S3['multipart_concurrency']),
+    )
+
 def configure_logging():
     logger = logging.getLogger()
     formatter = logging.Formatter(
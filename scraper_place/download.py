@@ -0,0 +1,184 @@
+"""download: Resumable downloads of the files of a DCE
+
+A download is written to {annonce_id}-{file_type}.part in blob_directory, and the validator of the response (ETag or
+Last-Modified) and its Content-Length are kept next to it. If the connection drops, the download resumes with a
+conditional Range request, in the same run or, if the annonce failed, in the next one. A response without validator
+cannot be told apart from a newer version of the file, its download restarts from the beginning. The file is only moved
+into place once complete (see blob_store).
+
+Use open_download() to send the request of a download and download() to write its body.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+from scraper_place import metrics
+from scraper_place.blob_store import commit_file
+from scraper_place.config import CONFIG_FETCH, CONFIG_FILE_STORAGE
+
+
+# The chunk size grows while the chunks arrive quickly, and shrinks on a slow connection
+MIN_CHUNK_SIZE = 65536
+MAX_CHUNK_SIZE = 4194304
+
+CONTENT_RANGE_REGEX = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+# Exceptions of a connection dropped while the body is read
+DOWNLOAD_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, ProtocolError, ReadTimeoutError)
+
+
+class RestartDownload(Exception):
+    pass
+
+
+def build_part_filepath(annonce_id, file_type):
+    return os.path.join(CONFIG_FILE_STORAGE['blob_directory'], '{}-{}.part'.format(annonce_id, file_type))
+
+
+def load_part_state(part_filepath):
+    try:
+        with open(part_filepath + '.json', 'r', encoding='UTF-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def resume_headers(part_filepath):
+    """resume_headers(): Headers of a request resuming the download of part_filepath, {} to start from the beginning
+    """
+    part_state = load_part_state(part_filepath)
+    if part_state is None or not os.path.exists(part_filepath):
+        return {}
+    offset = os.path.getsize(part_filepath)
+    validator = part_state.get('etag') or part_state.get('last_modified')
+    if not part_state['resumable'] or not validator or part_state.get('content_length') is None or offset == 0:
+        return {}
+
+    # The server only sends the rest of the file if it did not change, the whole file otherwise
+    return {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+
+
+def discard_part(part_filepath):
+    for path in [part_filepath, part_filepath + '.json']:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def open_download(open_response, annonce_id, file_type):
+    """open_download(): Send the request of a download with open_response(headers), resuming a previous download if any
+
+    Returns the response, with the status 200 or 206 if the request succeeded.
+    """
+    part_filepath = build_part_filepath(annonce_id, file_type)
+    response = open_response(resume_headers(part_filepath))
+    if response.status_code == 416:
+        # The part is not a prefix of the file anymore
+        response.close()
+        discard_part(part_filepath)
+        response = open_response({})
+    return response
+
+
+def download(response, open_response, annonce_id, file_type, public_filepath):
+    """download(): Write the body of the response of open_download() to the blob store, and link public_filepath to it
+
+    If the connection drops, the download is resumed with open_response(headers), up to max_download_resumes times.
+    Returns the size and the sha256 of the file.
+    """
+
+    part_filepath = build_part_filepath(annonce_id, file_type)
+    progress = {'hasher': None, 'size': 0}
+    nb_resumes = 0
+    while True:
+        try:
+            write_response(response, part_filepath, progress)
+            break
+        except RestartDownload:
+            discard_part(part_filepath)
+            response = open_response({})
+        except DOWNLOAD_EXCEPTIONS as exception:
+            nb_resumes += 1
+            if nb_resumes > int(CONFIG_FETCH['max_download_resumes']):
+                raise
+            logging.warning('Exception of type {} while downloading {}, resuming after {} bytes'.format(
+                type(exception).__name__, public_filepath, progress['size']))
+            metrics.count('fetch_download_resumes')
+            time.sleep(float(CONFIG_FETCH['retry_backoff']) * 2 ** nb_resumes)
+            response = open_download(open_response, annonce_id, file_type)
+
+    digest = progress['hasher'].hexdigest()
+    commit_file(part_filepath, digest, public_filepath)
+    os.remove(part_filepath + '.json')
+    return progress['size'], digest
+
+
+def write_response(response, part_filepath, progress):
+    """write_response(): Write or append the body of the response to the part file
+
+    progress: sha256 and size of the part file, kept up to date across the attempts
+    """
+
+    with response:
+        if response.status_code == 206:
+            match = CONTENT_RANGE_REGEX.match(response.headers.get('Content-Range', ''))
+            offset = os.path.getsize(part_filepath) if os.path.exists(part_filepath) else 0
+            part_state = load_part_state(part_filepath)
+            if (
+                match is None or int(match.groups()[0]) != offset
+                # The rest of a file of another size is not the rest of the part file
+                or part_state is None or part_state.get('content_length') is None
+                or match.groups()[2] != str(part_state['content_length'])
+            ):
+                raise RestartDownload()
+            mode = 'ab'
+            metrics.count('fetch_bytes_resumed', offset)
+            if progress['hasher'] is None or progress['size'] != offset:
+                # Resuming a download of a previous run, the bytes already there are hashed once
+                progress['hasher'] = hashlib.sha256()
+                with open(part_filepath, 'rb') as f:
+                    for chunk in iter(lambda: f.read(MAX_CHUNK_SIZE), b''):
+                        progress['hasher'].update(chunk)
+                progress['size'] = offset
+        elif response.status_code == 200:
+            mode = 'wb'
+            progress['hasher'] = hashlib.sha256()
+            progress['size'] = 0
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            content_length = response.headers.get('Content-Length')
+            with open(part_filepath + '.json', 'w', encoding='UTF-8') as f:
+                json.dump({
+                    # A Range applies to the encoded body, which is not what is written
+                    'resumable': 'Content-Encoding' not in response.headers and bool(etag or last_modified) and content_length is not None,
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'content_length': int(content_length) if content_length is not None else None,
+                }, f)
+        else:
+            raise Exception('Unexpected status {} for a download'.format(response.status_code))
+
+        chunk_size = MIN_CHUNK_SIZE
+        with open(part_filepath, mode) as file_object:
+            while True:
+                start = time.perf_counter()
+                chunk = response.raw.read(chunk_size, decode_content=True)
+                if not chunk:
+                    break
+                elapsed = time.perf_counter() - start
+                file_object.write(chunk)
+                # Flushed, so that the size of the part file is what was received if the connection drops
+                file_object.flush()
+                progress['hasher'].update(chunk)
+                progress['size'] += len(chunk)
+
+                if len(chunk) == chunk_size and elapsed < 0.1:
+                    chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+                elif elapsed > 1:
+                    chunk_size = max(chunk_size // 2, MIN_CHUNK_SIZE)
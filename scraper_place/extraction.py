@@ -1,91 +1,178 @@
 """extraction: Extract content using Apache Tika
 """
 
-import json
+import collections
+import datetime
+import itertools
 import os
+import shutil
+import tempfile
 import urllib
+import threading
 import traceback
 import time
 import logging
 import gzip
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 import requests
-import boto3
+import ijson
 
-from scraper_place.config import CONFIG_S3, CONFIG_TIKA, STATE_CONTENT_EXTRACTING, STATE_CONTENT_EXTRACTION_KO, STATE_CONTENT_EXTRACTION_OK, STATE_GLACIER_OK, build_extract_filepath, build_internal_filepath
+from scraper_place.config import CONFIG_FILE_STORAGE, CONFIG_S3, CONFIG_TIKA, STATE_CONTENT_EXTRACTING, STATE_CONTENT_EXTRACTION_KO, STATE_CONTENT_EXTRACTION_OK, STATE_GLACIER_OK, build_extract_filepath, build_internal_filepath, build_s3_resource
+from scraper_place import metrics
+from scraper_place.extraction_cache import ExtractionCache, stream_digest
+from scraper_place.schema import EXTRACTION_PROJECTION
 
 
-def extract():
+# The content extracted from a file is capped to its first and last CONTENT_MAX_SIZE / 2 characters, 0 for no cap.
+# See ipython notebook stats_elasticsearch
+CONTENT_MAX_SIZE = int(CONFIG_TIKA['content_max_size'])
+
+# The content of an archive member waiting to be written is kept in memory up to this size, on disk above
+MEMBER_SPOOL_SIZE = 1000000
+
+def extract(nb_workers=None):
     """extract: Extract content from all DCEs
+
+    nb_workers: number of DCE extracted concurrently, read from the [tika] config if None.
+    The workers are spread over the Tika servers listed in tika_server_url.
     """
 
-    s3_resource = boto3.session.Session(
-        aws_access_key_id=CONFIG_S3['aws_access_key_id'],
-        aws_secret_access_key=CONFIG_S3['aws_secret_access_key'],
-        region_name=CONFIG_S3['region_name'],
-    ).resource('s3')
+    if nb_workers is None:
+        nb_workers = int(CONFIG_TIKA['nb_workers'])
+    tika_server_urls = [url.strip() for url in CONFIG_TIKA['tika_server_url'].split(',')]
 
-    while True:
-        client = MongoClient()
-        collection = client.place.dce
-        dce_list = list(collection.find({'state': STATE_GLACIER_OK}).limit(1))
+    cache = build_extraction_cache()
 
-        if not dce_list:
-            client.close()
-            break
+    client = MongoClient()
+    collection = client.place.dce
 
-        dce_data = dce_list[0]
-        collection.update_one(
-            {'annonce_id': dce_data['annonce_id']},
-            {'$set': {'state': STATE_CONTENT_EXTRACTING}}
+    workers = [
+        threading.Thread(
+            target=extraction_worker,
+            kwargs={'collection': collection, 'tika_server_url': tika_server_urls[i % len(tika_server_urls)], 'cache': cache},
         )
-        client.close()
+        for i in range(nb_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    client.close()
+    metrics.write_report('extraction')
+
+def build_extraction_cache():
+    """build_extraction_cache: Return the ExtractionCache configured in the [tika] section, None if disabled
+    """
+
+    cache_max_size = int(float(CONFIG_TIKA['cache_max_size_mb']) * 1000000)
+    if not cache_max_size:
+        return None
+    return ExtractionCache(
+        directory=CONFIG_FILE_STORAGE['extract_cache_dir'],
+        max_size=cache_max_size,
+        variant=str(CONTENT_MAX_SIZE),
+    )
+
+
+def extraction_worker(collection, tika_server_url, cache=None):
+    """extraction_worker: Extract the DCEs one by one until there is no DCE left to claim
+    """
+
+    s3_resource = build_s3_resource()
+
+    while True:
+        dce_data = claim_dce(collection)
+        if dce_data is None:
+            break
 
         extract_dce(
             dce_data=dce_data,
-            tika_server_url=CONFIG_TIKA['tika_server_url'],
+            tika_server_url=tika_server_url,
             s3_resource=s3_resource,
+            collection=collection,
+            cache=cache,
         )
 
-def extract_dce(dce_data, tika_server_url, s3_resource):
+def build_claim_query(now):
+    """build_claim_query: Query of the DCE to extract, the ones in glacier_ok and the ones whose lease expired
+    """
+    lease_expiry = now - datetime.timedelta(hours=float(CONFIG_TIKA['lease_duration_hours']))
+    return {'$or': [
+        {'state': STATE_GLACIER_OK},
+        {'state': STATE_CONTENT_EXTRACTING, 'extraction_start_datetime': {'$lt': lease_expiry}},
+        {'state': STATE_CONTENT_EXTRACTING, 'extraction_start_datetime': {'$exists': False}},
+    ]}
+
+def claim_dce(collection, annonce_id=None):
+    """claim_dce: Atomically take a DCE to extract, so that no two workers extract the same DCE.
+
+    A DCE stays claimed for lease_duration_hours. After that, it is considered abandoned by a crashed worker and can be
+    claimed again. The oldest DCE are claimed first, only the fields needed by extract_dce() are returned.
+    annonce_id: claim this DCE only, None to claim any DCE
+    Returns None if there is no DCE to extract.
+    """
+
+    now = datetime.datetime.now()
+    query = build_claim_query(now)
+    if annonce_id is not None:
+        query['annonce_id'] = annonce_id
+
+    return collection.find_one_and_update(
+        query,
+        {'$set': {'state': STATE_CONTENT_EXTRACTING, 'extraction_start_datetime': now}, '$currentDate': {'last_modified': True}},
+        projection=EXTRACTION_PROJECTION,
+        sort=[('fetch_datetime', 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+def extract_dce(dce_data, tika_server_url, s3_resource, collection, cache=None):
     """extract_dce: Extract the content of one DCE
+
+    cache: ExtractionCache consulted before sending a file to Tika, None to always use Tika
     """
 
+    start = time.perf_counter()
     try:
         annonce_id = dce_data['annonce_id']
         logging.debug('{} extracting content for DCE {}'.format(time.ctime(), annonce_id))
 
-        content_list = []
-
         file_types = ['reglement', 'complement', 'avis', 'dce']
         filenames = [dce_data['filename_reglement'], dce_data['filename_complement'], dce_data['filename_avis'], dce_data['filename_dce']]
 
-        for file_type, filename in zip(file_types, filenames):
-            if not filename:
-                continue
-
-            internal_filepath = build_internal_filepath(annonce_id=annonce_id, original_filename=filename, file_type=file_type)
-            logging.debug('Extracting content of {}...'.format(internal_filepath))
-
-            content, embedded_resource_paths = extract_file(file_path=internal_filepath, tika_server_url=tika_server_url)
-
-            client = MongoClient()
-            collection = client.place.dce
-            collection.update_one(
-                {'annonce_id': annonce_id},
-                {'$set': {'embedded_filenames_{}'.format(file_type): embedded_resource_paths}}
-            )
-            client.close()
-
-            content_list.append(content)
-
-        content = '\n'.join(content_list)
-
         extract_filepath = build_extract_filepath(annonce_id)
         extract_filename = os.path.basename(extract_filepath)
-        with gzip.open(extract_filepath, 'wt', encoding='UTF-8') as f:
-            f.write(content)
+
+        # The content of each file is written to the extract file as Tika sends it
+        with gzip.open(extract_filepath, 'wt', encoding='UTF-8') as extract_file_object:
+            is_first_file = True
+            for file_type, filename in zip(file_types, filenames):
+                if not filename:
+                    continue
+
+                internal_filepath = build_internal_filepath(annonce_id=annonce_id, original_filename=filename, file_type=file_type)
+                logging.debug('Extracting content of {}...'.format(internal_filepath))
+
+                if not is_first_file:
+                    extract_file_object.write('\n')
+                is_first_file = False
+
+                embedded_resource_paths = extract_file(
+                    file_path=internal_filepath,
+                    tika_server_url=tika_server_url,
+                    output=extract_file_object,
+                    cache=cache,
+                    digest=dce_data.get('sha256_{}'.format(file_type)),
+                )
+
+                collection.update_one(
+                    {'annonce_id': annonce_id},
+                    {'$set': {'embedded_filenames_{}'.format(file_type): embedded_resource_paths}, '$currentDate': {'last_modified': True}}
+                )
 
         s3_resource.meta.client.upload_file(
             Filename=extract_filepath,
@@ -94,57 +181,286 @@ def extract_dce(dce_data, tika_server_url, s3_resource):
             ExtraArgs={'StorageClass': 'ONEZONE_IA'}
         )
 
-        client = MongoClient()
-        collection = client.place.dce
         collection.update_one(
             {'annonce_id': annonce_id},
-            {'$set': {'state': STATE_CONTENT_EXTRACTION_OK}}
+            {'$set': {'state': STATE_CONTENT_EXTRACTION_OK}, '$currentDate': {'last_modified': True}}
         )
-        client.close()
 
         logging.debug('Extracted content from {}'.format(annonce_id))
+        metrics.observe('extraction_dce_seconds', time.perf_counter() - start)
+        metrics.count('extraction_dce_extracted')
 
     except Exception as exception:
+        metrics.failure('extraction', exception)
         logging.warning("Exception of type {} occured, aborting DCE {}".format(type(exception).__name__, annonce_id))
         logging.debug("Exception details: {}".format(exception))
         logging.debug(traceback.format_exc())
 
-        client = MongoClient()
-        collection = client.place.dce
         collection.update_one(
             {'annonce_id': annonce_id},
-            {'$set': {'state': STATE_CONTENT_EXTRACTION_KO}}
+            {'$set': {'state': STATE_CONTENT_EXTRACTION_KO}, '$currentDate': {'last_modified': True}}
         )
-        client.close()
         time.sleep(5)  # Give some time to the Tika server to restart
 
-def extract_file(file_path, tika_server_url):
+def extract_file(file_path, tika_server_url, output, cache=None, digest=None):
+    """extract_file: Extract the content of one file with Tika and write it to output
+
+    The JSON array sent by Tika is parsed one embedded document at a time, so that the whole response is never held
+    in memory. The content written is capped to its first and last CONTENT_MAX_SIZE / 2 characters.
+    If a cache is given, a file with the same content as an already extracted file is not sent to Tika.
+    If unpack_archives is set in the [tika] config, the .zip archives are extracted member by member (see
+    extract_archive). Office and OpenDocument files are zip containers too, but they are sent to Tika whole.
+    digest: sha256 of the file if already known (see blob_store), to look it up in the cache without reading it
+
+    Returns the sorted list of the embedded resource paths.
+    """
+    is_zip_archive = os.path.splitext(file_path)[1].lower() == '.zip' and zipfile.is_zipfile(file_path)
+    if CONFIG_TIKA['unpack_archives'] == 'true' and is_zip_archive:
+        return extract_archive(file_path=file_path, tika_server_url=tika_server_url, output=output, cache=cache)
+
+    return extract_stream(
+        open_stream=lambda: open(file_path, 'rb'),
+        tika_server_url=tika_server_url,
+        output=output,
+        cache=cache,
+        timeout=3600,
+        digest=digest,
+    )
+
+
+def extract_archive(file_path, tika_server_url, output, cache=None):
+    """extract_archive: Extract the members of a zip archive concurrently and write their content to output
+
+    The archive is read locally: the members of an unwanted type are skipped before reaching Tika, and the wanted ones
+    are streamed to Tika in parallel, each with its own timeout. A member that fails is logged and skipped, the
+    extraction only fails if no wanted member could be extracted.
+    At most 2 * archive_workers members are extracted ahead of the one written to output, and their contents are
+    spooled to temporary files above MEMBER_SPOOL_SIZE bytes: a slow member does not keep the others in memory.
+
+    Returns the sorted list of the members (and of the documents embedded in the members that are archives).
+    """
+    with zipfile.ZipFile(file_path) as archive:
+        members = [info for info in archive.infolist() if not info.is_dir()]
+
+    wanted_members = [info for info in members if is_archive(info.filename) or not is_unwanted_type(info.filename)]
+    embedded_resource_paths = ['/' + info.filename for info in members]
+
+    archive_workers = int(CONFIG_TIKA['archive_workers'])
+    with ThreadPoolExecutor(max_workers=archive_workers) as executor:
+        def submit(info):
+            future = executor.submit(
+                extract_archive_member,
+                file_path=file_path,
+                info=info,
+                tika_server_url=tika_server_url,
+                cache=cache,
+            )
+            return info, future
+
+        remaining_members = iter(wanted_members)
+        pending = collections.deque(submit(info) for info in itertools.islice(remaining_members, 2 * archive_workers))
+
+        writer = capped_writer(output)
+        failed_members = []
+        is_first_member = True
+        # The contents are written in the order of the archive
+        while pending:
+            info, future = pending.popleft()
+            for next_info in itertools.islice(remaining_members, 1):
+                pending.append(submit(next_info))
+            try:
+                member_output, member_resource_paths = future.result()
+            except Exception as exception:
+                logging.warning("Exception of type {} on member {} of {}".format(type(exception).__name__, info.filename, file_path))
+                logging.debug("Exception details: {}".format(exception))
+                failed_members.append(info.filename)
+                continue
+
+            with member_output:
+                if not is_first_member:
+                    writer.write('\n')
+                is_first_member = False
+                member_output.seek(0)
+                shutil.copyfileobj(member_output, writer)
+            embedded_resource_paths += [
+                '/' + info.filename + path for path in member_resource_paths if path.startswith('/')
+            ]
+        writer.close()
+
+    if wanted_members and len(failed_members) == len(wanted_members):
+        raise Exception('No member of {} could be extracted'.format(file_path))
+
+    return sorted(embedded_resource_paths)
+
+
+def extract_archive_member(file_path, info, tika_server_url, cache):
+    """extract_archive_member: Extract one member of a zip archive, return its content and its embedded resource paths
+
+    The content is returned as a file object, spooled to disk above MEMBER_SPOOL_SIZE bytes. The caller closes it.
+    """
+    @contextmanager
+    def open_member():
+        # Each call opens the archive again, a ZipFile should not be shared between threads
+        with zipfile.ZipFile(file_path) as archive:
+            with archive.open(info) as member:
+                yield member
+
+    member_output = tempfile.SpooledTemporaryFile(max_size=MEMBER_SPOOL_SIZE, mode='w+', encoding='UTF-8')
+    try:
+        member_resource_paths = extract_stream(
+            open_stream=open_member,
+            tika_server_url=tika_server_url,
+            output=member_output,
+            cache=cache,
+            timeout=int(CONFIG_TIKA['member_timeout_seconds']),
+            filename=os.path.basename(info.filename),
+        )
+    except Exception:
+        member_output.close()
+        raise
+    return member_output, member_resource_paths
+
+
+def extract_stream(open_stream, tika_server_url, output, cache, timeout, filename=None, digest=None):
+    """extract_stream: Extract the content of the binary stream returned by open_stream(), using the cache if any
+    """
+    if cache is None:
+        return extract_stream_with_tika(open_stream, tika_server_url=tika_server_url, output=output, timeout=timeout, filename=filename)
+
+    if digest is None:
+        with open_stream() as stream:
+            digest = stream_digest(stream)
+    embedded_resource_paths = cache.lookup(digest, output)
+    if embedded_resource_paths is not None:
+        logging.debug('Found the content of {} in the extraction cache'.format(filename or digest))
+        metrics.count('extraction_cache_hits')
+        return embedded_resource_paths
+    metrics.count('extraction_cache_misses')
+
+    cache_entry = cache.new_entry(digest)
+    try:
+        embedded_resource_paths = extract_stream_with_tika(
+            open_stream,
+            tika_server_url=tika_server_url,
+            output=TeeWriter(output, cache_entry),
+            timeout=timeout,
+            filename=filename,
+        )
+    except Exception:
+        cache_entry.abort()
+        raise
+    cache_entry.commit(embedded_resource_paths)
+
+    return embedded_resource_paths
+
+
+def extract_stream_with_tika(open_stream, tika_server_url, output, timeout, filename=None):
     url = urllib.parse.urljoin(tika_server_url, '/rmeta/text')
     headers = {
         'Accept': 'application/json',
     }
-    with open(file_path, 'rb') as file_object:
-        response = requests.put(url, headers=headers, data=file_object, timeout=3600)
-    assert response.status_code == 200, (response.status_code, response.text)
-
-    tika_result = json.loads(response.content)  # better than r.text that takes hours to compute
+    if filename:
+        # Helps Tika to detect the type of the document
+        headers['Content-Disposition'] = 'attachment; filename={}'.format(urllib.parse.quote(filename))
+
+    def read_chunk(stream):
+        chunk = stream.read(1048576)
+        metrics.count('extraction_bytes_sent_to_tika', len(chunk))
+        return chunk
+
+    with metrics.timer('extraction_tika_request_seconds'):
+        with open_stream() as stream:
+            response = requests.put(
+                url,
+                headers=headers,
+                data=iter(lambda: read_chunk(stream), b''),
+                timeout=timeout,
+                stream=True,
+            )
 
-    content_list, embedded_resource_paths = filter_content(tika_result)
+        with response:
+            assert response.status_code == 200, (response.status_code, response.text)
 
-    content = '\n'.join(content_list)
+            response.raw.decode_content = True
+            tika_result = ijson.items(response.raw, 'item')
 
-    # See ipython notebook stats_elasticsearch
-    if len(content) > 10000000:
-        content = content[:5000000] + content[-5000000:]
+            embedded_resource_paths = []
+            writer = capped_writer(output)
+            for index, file_content in enumerate(filter_content(tika_result, embedded_resource_paths)):
+                if index > 0:
+                    writer.write('\n')
+                writer.write(file_content)
+            writer.close()
 
     embedded_resource_paths = sorted(embedded_resource_paths)
 
-    return content, embedded_resource_paths
+    return embedded_resource_paths
 
 
-def filter_content(tika_result):
-    content_list = []
-    embedded_resource_paths = []
+class TeeWriter:
+    """TeeWriter: Write the same text to several outputs
+    """
+
+    def __init__(self, *outputs):
+        self.outputs = outputs
+
+    def write(self, text):
+        for output in self.outputs:
+            output.write(text)
+
+
+def capped_writer(output):
+    """capped_writer: Return a HeadTailWriter to output that applies the CONTENT_MAX_SIZE cap
+    """
+    if not CONTENT_MAX_SIZE:
+        return HeadTailWriter(output, head_size=None, tail_size=0)
+    return HeadTailWriter(output, head_size=CONTENT_MAX_SIZE // 2, tail_size=CONTENT_MAX_SIZE - CONTENT_MAX_SIZE // 2)
+
+
+class HeadTailWriter:
+    """HeadTailWriter: Write the first head_size and the last tail_size characters of a text to output
+
+    The head is written as soon as it is received, only the last tail_size characters are kept in memory until close().
+    head_size: None to write the whole text
+    """
+
+    def __init__(self, output, head_size, tail_size):
+        self.output = output
+        self.head_remaining = head_size
+        self.tail_size = tail_size
+        self.tail_chunks = []
+        self.tail_length = 0
+
+    def write(self, text):
+        if self.head_remaining is None:
+            self.output.write(text)
+            return
+        if self.head_remaining > 0:
+            head = text[:self.head_remaining]
+            self.output.write(head)
+            self.head_remaining -= len(head)
+            text = text[len(head):]
+        if not text:
+            return
+
+        self.tail_chunks.append(text)
+        self.tail_length += len(text)
+        while self.tail_chunks and self.tail_length - len(self.tail_chunks[0]) >= self.tail_size:
+            self.tail_length -= len(self.tail_chunks.pop(0))
+
+    def close(self):
+        tail = ''.join(self.tail_chunks)
+        self.output.write(tail[len(tail) - self.tail_size:] if len(tail) > self.tail_size else tail)
+        self.tail_chunks = []
+        self.tail_length = 0
+
+
+def filter_content(tika_result, embedded_resource_paths):
+    """filter_content: Yield the content of the wanted documents of a Tika result
+
+    tika_result: iterable of the documents returned by Tika
+    embedded_resource_paths: list to which the paths of all the documents are appended
+    """
     for file_data in tika_result:
         if 'X-TIKA:embedded_resource_path' in file_data:
             embedded_resource_paths.append(file_data['X-TIKA:embedded_resource_path'])
@@ -158,9 +474,12 @@ def filter_content(tika_result):
 
         if 'X-TIKA:content' in file_data:  # can also be a image PDF
             file_content = file_data['X-TIKA:content']
-            content_list.append(file_content)
+            yield file_content
 
-    return content_list, embedded_resource_paths
+
+def is_archive(filename):
+    _, file_extension = os.path.splitext(filename)
+    return file_extension.lower() in {'.zip', '.7z', '.rar', '.tar', '.gz'}
 
 
 def is_unwanted_type(filename):
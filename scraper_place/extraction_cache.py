@@ -0,0 +1,166 @@
+"""extraction_cache: Cache the content extracted by Tika, keyed by the hash of the extracted file
+
+PLACE often publishes the same reglement, avis or archive for several annonces, and a DCE in extraction_ko is
+extracted again file by file. The cache avoids sending the same bytes to Tika twice.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+
+# Bump when the extracted content changes for the same file (filtering, size cap...), to invalidate the cache
+CACHE_VERSION = '1'
+
+# The eviction brings the cache down to this share of max_size, so that it does not run again at the next entry
+EVICTION_TARGET = 0.9
+
+
+def stream_digest(stream):
+    """stream_digest: Return the sha256 of the content of a binary stream, read until its end
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(1048576), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(file_path):
+    """file_digest: Return the sha256 of the content of a file
+    """
+    with open(file_path, 'rb') as file_object:
+        return stream_digest(file_object)
+
+
+class ExtractionCache:
+    """ExtractionCache: Directory of extracted contents, evicting the least recently used ones above max_size bytes
+
+    variant: part of the key of the entries, to separate the contents extracted with different settings
+
+    Each entry is made of {key}.txt.gz (the extracted content) and {key}.json (the embedded resource paths).
+    The size of the cache is kept up to date as the entries are committed, the directory is only scanned at startup and
+    when the size goes over max_size.
+    """
+
+    def __init__(self, directory, max_size, variant=''):
+        self.directory = directory
+        self.max_size = max_size
+        self.variant = variant
+        self._eviction_lock = threading.Lock()
+        _, self._size = self._scan()
+
+    def _paths(self, digest):
+        key = '{}{}-{}'.format(CACHE_VERSION, self.variant, digest)
+        return os.path.join(self.directory, key + '.txt.gz'), os.path.join(self.directory, key + '.json')
+
+    def lookup(self, digest, output):
+        """lookup: If the digest is cached, write its content to output and return its embedded resource paths.
+
+        Returns None if the digest is not cached.
+        """
+        content_path, metadata_path = self._paths(digest)
+        try:
+            with open(metadata_path, 'r', encoding='UTF-8') as f:
+                embedded_resource_paths = json.load(f)
+            with gzip.open(content_path, 'rt', encoding='UTF-8') as f:
+                shutil.copyfileobj(f, output)
+        except FileNotFoundError:  # not cached, or evicted by another worker
+            return None
+
+        # The modification time tells the eviction which entries were used recently
+        os.utime(content_path)
+        os.utime(metadata_path)
+        return embedded_resource_paths
+
+    def new_entry(self, digest):
+        return CacheEntry(self, digest)
+
+    def _scan(self):
+        """_scan: Return the entries of the cache (modification time, size, content path, metadata path) and their total size
+        """
+        entries = []
+        total_size = 0
+        try:
+            dir_entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return entries, total_size
+        for dir_entry in dir_entries:
+            if not dir_entry.name.endswith('.json'):
+                continue
+            content_path = dir_entry.path[:-len('.json')] + '.txt.gz'
+            try:
+                size = dir_entry.stat().st_size + os.path.getsize(content_path)
+            except FileNotFoundError:
+                continue
+            entries.append((dir_entry.stat().st_mtime, size, content_path, dir_entry.path))
+            total_size += size
+        return entries, total_size
+
+    def add(self, size):
+        """add: Count a new entry of size bytes, and evict entries if the cache is now over max_size bytes
+        """
+        with self._eviction_lock:
+            self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def evict(self):
+        """evict: Remove the least recently used entries until the cache is under EVICTION_TARGET * max_size bytes
+        """
+        with self._eviction_lock:
+            self._evict()
+
+    def _evict(self):
+        entries, total_size = self._scan()
+        entries.sort()
+        for _, size, content_path, metadata_path in entries:
+            if total_size <= self.max_size * EVICTION_TARGET:
+                break
+            # The metadata is removed first, an entry without metadata is a cache miss
+            try:
+                os.remove(metadata_path)
+                os.remove(content_path)
+            except FileNotFoundError:  # being replaced by a worker storing the same file
+                pass
+            total_size -= size
+            logging.debug('Evicted {} from the extraction cache'.format(content_path))
+        self._size = total_size
+
+
+class CacheEntry:
+    """CacheEntry: Entry being written, only visible in the cache once committed
+    """
+
+    def __init__(self, cache, digest):
+        self.cache = cache
+        self.content_path, self.metadata_path = cache._paths(digest)
+        file_descriptor, self.temporary_path = tempfile.mkstemp(dir=cache.directory, suffix='.tmp')
+        self.raw_file_object = os.fdopen(file_descriptor, 'wb')
+        self.file_object = gzip.open(self.raw_file_object, 'wt', encoding='UTF-8')
+
+    def write(self, text):
+        self.file_object.write(text)
+
+    def close(self):
+        # Closing the gzip stream does not close the file object it wraps
+        self.file_object.close()
+        self.raw_file_object.close()
+
+    def commit(self, embedded_resource_paths):
+        self.close()
+        temporary_metadata_path = self.temporary_path + '.meta'
+        with open(temporary_metadata_path, 'w', encoding='UTF-8') as f:
+            json.dump(embedded_resource_paths, f)
+        size = os.path.getsize(self.temporary_path) + os.path.getsize(temporary_metadata_path)
+        os.replace(self.temporary_path, self.content_path)
+        os.replace(temporary_metadata_path, self.metadata_path)
+        self.cache.add(size)
+
+    def abort(self):
+        self.close()
+        os.remove(self.temporary_path)
@@ -1,133 +1,534 @@
 """fetch: Fetch the new DCE from https://www.marches-publics.gouv.fr/
 
 Use fetch_new_dce() to store metadata in database and store the archives in the public directory.
-Use fetch_current_annonces() to fetch the list of currently available DCE.
+Use fetch_current_annonces() to fetch the list of currently available DCE, or iter_current_annonces() to get them while paging.
 Use fetch_data() to fetch the metadata and the files custituting a DCE.
+Use check_link() to fetch again a known DCE whose annonce changed.
 """
 
 import datetime
+import hashlib
+import json
 import re
-from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 import traceback
 import os
 import logging
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from pymongo import MongoClient
 
-from scraper_place.config import CONFIG_ENV, STATE_FETCH_OK, build_internal_filepath
+from scraper_place import blob_store, metrics
+from scraper_place.download import download, open_download
+from scraper_place.config import CONFIG_ENV, CONFIG_FETCH, CONFIG_FILE_STORAGE, STATE_FETCH_OK, build_internal_filepath
+from scraper_place.fetch_client import FetchClient
 
 
 URL_SEARCH = 'https://www.marches-publics.gouv.fr/?page=Entreprise.EntrepriseAdvancedSearch&AllCons'
 
-PAGE_STATE_REGEX = 'name="PRADO_PAGESTATE" id="PRADO_PAGESTATE" value="([a-zA-Z0-9/+=]+)"'
-LINK_REGEX = r'^https://www\.marches-publics\.gouv\.fr/app\.php/entreprise/consultation/([\d]+)\?orgAcronyme=([\da-z]+)$'
-REGLEMENT_REGEX = r'^/index.php\?page=Entreprise\.EntrepriseDownloadReglement&id=([a-zA-Z\d=]+)&orgAcronyme=([\da-z]+)$'
-BOAMP_REGEX = r'^http://www\.boamp\.fr/(?:index\.php/)?avis/detail/([\d-]+)(?:/[\d]+)?$'
+PAGE_STATE_REGEX = re.compile('name="PRADO_PAGESTATE" id="PRADO_PAGESTATE" value="([a-zA-Z0-9/+=]+)"')
+LINK_REGEX = re.compile(r'^https://www\.marches-publics\.gouv\.fr/app\.php/entreprise/consultation/([\d]+)\?orgAcronyme=([\da-z]+)$')
+REGLEMENT_REGEX = re.compile(r'^/index.php\?page=Entreprise\.EntrepriseDownloadReglement&id=([a-zA-Z\d=]+)&orgAcronyme=([\da-z]+)$')
+BOAMP_REGEX = re.compile(r'^http://www\.boamp\.fr/(?:index\.php/)?avis/detail/([\d-]+)(?:/[\d]+)?$')
 
+# Number of results per page of the listing, see init()
+LISTING_PAGE_SIZE = 20
 
+# lxml is several times faster than html.parser on the listing pages, which embed a ~100kB page state
+HTML_PARSER = 'lxml'
 
-def fetch_new_dce():
+
+def fetch_new_dce(nb_pages=None, fetch_client=None, database=None, on_fetched=None):
     """fetch_new_dce: fetch the DCEs that are not already in the database, stores metadata in database and stores the archives in the public directory.
-    """
 
-    if CONFIG_ENV['env'] == 'production':
-        nb_pages = 0
-    else:
-        nb_pages = 1
+    nb_pages: number of pages of the listing to fetch, 0 to set no limit, None to choose from the env
+    fetch_client: FetchClient to use, a new one is created if None
+    database: mongo database to use, the place database on localhost if None
+    on_fetched: if not None, called by the workers with the data of each DCE stored
 
-    links = fetch_current_annonces(nb_pages=nb_pages)
-    logging.debug("{} links".format(len(links)))
+    Returns the number of stored DCE.
+    """
 
-    nb_processed = 0
-    for link in links:
-        nb_processed += process_link(link)
+    if nb_pages is None:
+        if CONFIG_ENV['env'] == 'production':
+            nb_pages = 0
+        else:
+            nb_pages = 1
+
+    own_fetch_client = fetch_client is None
+    if own_fetch_client:
+        fetch_client = FetchClient()
+    client = None
+    if database is None:
+        client = MongoClient()
+        database = client.place
+    collection = database.dce
+
+    # Most of the listed DCE are already in the database, load their ids once instead of querying for each link
+    known_annonce_ids = load_known_annonce_ids(collection)
+    logging.debug("{} DCE already in the database".format(len(known_annonce_ids)))
+
+    # The known DCE not checked for changes since refetch_interval_days are checked, at most refetch_max_checks per run
+    max_checks = int(CONFIG_FETCH['refetch_max_checks'])
+    annonce_ids_to_check = load_annonce_ids_to_check(collection) if max_checks else set()
+
+    # Stop paging once the listing only shows known DCE, except for a periodic full sweep
+    crawl_collection = database.crawl
+    full_sweep = is_full_sweep_due(crawl_collection)
+    stop_after_known_pages = 0 if full_sweep else int(CONFIG_FETCH['stop_after_known_pages'])
+    crawl_stats = {}
+    start_datetime = datetime.datetime.now()
+
+    # The links are downloaded while the listing is still paging. The semaphore bounds the number of links
+    # waiting for a worker, so that paging does not run far ahead of the downloads.
+    pending_links = threading.BoundedSemaphore(int(CONFIG_FETCH['link_queue_size']))
+    futures = []
+    check_futures = []
+
+    def release_link(future):
+        pending_links.release()
+        metrics.gauge_add('fetch_pending_links', -1)
+
+    # process_link() isolates the errors of each annonce, so the workers can share the stream of links
+    with ThreadPoolExecutor(max_workers=fetch_client.max_workers) as executor:
+        links = iter_current_annonces(
+            nb_pages=nb_pages,
+            fetch_client=fetch_client,
+            known_annonce_ids=known_annonce_ids,
+            stop_after_known_pages=stop_after_known_pages,
+            crawl_stats=crawl_stats,
+            checkpoint_path=CONFIG_FILE_STORAGE['crawl_checkpoint_path'],
+        )
+        for link in links:
+            annonce_id = annonce_id_from_link(link)
+            if annonce_id in known_annonce_ids:
+                if annonce_id in annonce_ids_to_check and len(check_futures) < max_checks:
+                    annonce_ids_to_check.discard(annonce_id)
+                    pending_links.acquire()
+                    metrics.gauge_add('fetch_pending_links', 1)
+                    future = executor.submit(check_link, link, collection=collection, fetch_client=fetch_client, on_fetched=on_fetched)
+                    future.add_done_callback(release_link)
+                    check_futures.append(future)
+                continue
+
+            pending_links.acquire()
+            metrics.gauge_add('fetch_pending_links', 1)
+            future = executor.submit(process_link, link, collection=collection, fetch_client=fetch_client, on_fetched=on_fetched)
+            future.add_done_callback(release_link)
+            futures.append(future)
+
+    nb_processed = sum(future.result() for future in futures)
     logging.info("Processed {} DCE".format(nb_processed))
+    nb_refetched = sum(future.result() for future in check_futures)
+    if check_futures:
+        logging.info("Checked {} known DCE, fetched {} again".format(len(check_futures), nb_refetched))
+
+    # The downloads are over, no blob is being committed
+    try:
+        nb_files, nb_bytes = blob_store.sweep(float(CONFIG_FILE_STORAGE['blob_max_unused_days']))
+        logging.info("Removed {} unused files from the blob store, {:.1f} MB".format(nb_files, nb_bytes / 1e6))
+    except Exception as exception:
+        logging.warning("Exception of type {} while sweeping the blob store".format(type(exception).__name__))
+        logging.debug("Exception details: {}".format(exception))
+        logging.debug(traceback.format_exc())
+
+    crawl_collection.insert_one({
+        'start_datetime': start_datetime,
+        'end_datetime': datetime.datetime.now(),
+        'full_sweep': full_sweep,
+        'nb_processed': nb_processed,
+        'nb_checked': len(check_futures),
+        'nb_refetched': nb_refetched,
+        **crawl_stats,
+    })
+
+    if client is not None:
+        client.close()
+    if own_fetch_client:
+        fetch_client.close()
+
+    metrics.count('fetch_dce_stored', nb_processed)
+    metrics.count('fetch_dce_checked', len(check_futures))
+    metrics.count('fetch_dce_refetched', nb_refetched)
+    for name in ['nb_pages', 'nb_links', 'nb_new_links', 'nb_duplicates']:
+        metrics.count('fetch_listing_{}'.format(name[len('nb_'):]), crawl_stats.get(name, 0))
+    metrics.write_report('fetch')
+
+    return nb_processed
+
+
+def is_full_sweep_due(crawl_collection):
+    """is_full_sweep_due(): Tell whether the last complete full sweep of the listing is older than full_sweep_interval_days.
+    """
+    last_full_sweep = crawl_collection.find_one(
+        {'full_sweep': True, 'complete': True},
+        sort=[('start_datetime', -1)],
+    )
+    if last_full_sweep is None:
+        return True
+
+    full_sweep_interval = datetime.timedelta(days=float(CONFIG_FETCH['full_sweep_interval_days']))
+    return last_full_sweep['start_datetime'] < datetime.datetime.now() - full_sweep_interval
+
+
+def load_known_annonce_ids(collection):
+    """load_known_annonce_ids(): Return the set of the annonce_id already stored in the collection.
+    """
+    cursor = collection.find({}, {'annonce_id': True, '_id': False})
+    return {dce_data['annonce_id'] for dce_data in cursor}
 
 
-def process_link(link):
+def process_link(link, collection, fetch_client=None, on_fetched=None):
     """
     process_link : Download data and store it in database.
+    The caller is responsible for skipping the DCE already in the database (see load_known_annonce_ids()).
+    on_fetched: if not None, called with the data of the DCE once stored
     Return the number of stored DCE (0 or 1).
     """
-    annonce_id = re.match(LINK_REGEX, link).groups()[0]
+    try:
+        with metrics.timer('fetch_dce_seconds'):
+            annonce_data = fetch_data(link, fetch_client=fetch_client)
+    except Exception as exception:
+        metrics.failure('fetch', exception)
+        logging.warning("Exception of type {} on {}".format(type(exception).__name__, link))
+        logging.debug("Exception details: {}".format(exception))
+        logging.debug(traceback.format_exc())
+        return 0
+
+    annonce_data['fetch_datetime'] = datetime.datetime.now()
+    annonce_data['state'] = STATE_FETCH_OK
+    # In UTC, like the $currentDate of the updates by the next stages, see metadata.backup()
+    annonce_data['last_modified'] = datetime.datetime.now(datetime.timezone.utc)
 
-    client = MongoClient()
-    collection = client.place.dce
+    collection.insert_one(annonce_data)
+    if on_fetched is not None:
+        on_fetched(annonce_data)
+
+    return 1
 
-    # abort if the DCE is already processed
-    if collection.count_documents({'annonce_id': annonce_id}, limit=1):
+
+def load_annonce_ids_to_check(collection):
+    """load_annonce_ids_to_check(): Return the set of the annonce_id not fetched nor checked for refetch_interval_days.
+    """
+    limit = datetime.datetime.now() - datetime.timedelta(days=float(CONFIG_FETCH['refetch_interval_days']))
+    cursor = collection.find(
+        {'fetch_datetime': {'$lt': limit}, '$or': [{'check_datetime': {'$lt': limit}}, {'check_datetime': {'$exists': False}}]},
+        {'annonce_id': True, '_id': False},
+    )
+    return {dce_data['annonce_id'] for dce_data in cursor}
+
+
+def check_link(link, collection, fetch_client=None, on_fetched=None):
+    """
+    check_link : Check whether a known DCE changed since it was fetched, and fetch it again if so.
+    The DCE fetched again goes through all the stages again, and replaces its previous version in the index.
+    on_fetched: if not None, called with the data of the DCE once stored
+    Return the number of DCE fetched again (0 or 1).
+    """
+    annonce_id = annonce_id_from_link(link)
+    dce_data = collection.find_one({'annonce_id': annonce_id})
+    if fetch_client is None:
+        fetch_client = FetchClient()
+
+    session = fetch_client.new_session()
+    try:
+        with metrics.timer('fetch_check_seconds'):
+            annonce_page = fetch_annonce_page(session, link)
+            changed, fingerprint = has_changed(session, annonce_page, dce_data)
+    except Exception as exception:
+        metrics.failure('fetch', exception)
+        logging.warning("Exception of type {} while checking {}".format(type(exception).__name__, link))
+        logging.debug("Exception details: {}".format(exception))
+        logging.debug(traceback.format_exc())
+        return 0
+
+    if not changed:
+        collection.update_one(
+            {'annonce_id': annonce_id},
+            {'$set': {'check_datetime': datetime.datetime.now(), 'fingerprint': fingerprint}, '$currentDate': {'last_modified': True}},
+        )
         return 0
 
+    logging.info('DCE {} changed, fetching it again'.format(annonce_id))
     try:
-        annonce_data = fetch_data(link)
+        annonce_data = fetch_data(link, fetch_client=fetch_client, session=session, annonce_page=annonce_page)
     except Exception as exception:
+        metrics.failure('fetch', exception)
         logging.warning("Exception of type {} on {}".format(type(exception).__name__, link))
         logging.debug("Exception details: {}".format(exception))
         logging.debug(traceback.format_exc())
         return 0
 
     annonce_data['fetch_datetime'] = datetime.datetime.now()
+    annonce_data['check_datetime'] = annonce_data['fetch_datetime']
     annonce_data['state'] = STATE_FETCH_OK
-
-    collection.insert_one(annonce_data)
-    client.close()
+    # The indexation replaces the documents of the previous version, see indexation.index()
+    annonce_data['refetched'] = True
+    collection.update_one(
+        {'annonce_id': annonce_id},
+        {'$set': annonce_data, '$currentDate': {'last_modified': True}},
+    )
+    if on_fetched is not None:
+        on_fetched(annonce_data)
 
     return 1
 
 
-def fetch_current_annonces(nb_pages=0):
+def has_changed(session, annonce_page, dce_data):
+    """has_changed(): Tell whether the annonce page or the files of a known DCE changed since it was fetched
+
+    annonce_page: the current annonce page, see fetch_annonce_page()
+    The files are only checked with HEAD requests (size and filename), the DCE archive is not: it can only be reached
+    through a PRADO form, and a new version of it comes with a new version of the page.
+    Returns whether the DCE changed, and the fingerprint of the annonce page.
+    """
+    fingerprint = annonce_fingerprint(annonce_page)
+    # The DCE fetched before the fingerprints were stored only have their files checked
+    if dce_data.get('fingerprint') not in (None, fingerprint):
+        return True, fingerprint
+
+    for file_type in ['avis', 'reglement', 'complement', 'dce']:
+        if bool(annonce_page['link_{}'.format(file_type)]) != bool(dce_data['filename_{}'.format(file_type)]):
+            return True, fingerprint
+
+    if CONFIG_FETCH['refetch_probe_files'] == 'true':
+        for file_type in ['avis', 'reglement', 'complement']:
+            link_file = annonce_page['link_{}'.format(file_type)]
+            if not link_file:
+                continue
+            # file_size_* is the decoded size, the Content-Length of a compressed response cannot be compared to it
+            headers = {'Accept-Encoding': 'identity'}
+            response = session.head('https://www.marches-publics.gouv.fr{}'.format(link_file), allow_redirects=False, headers=headers)
+            if response.status_code in (405, 501):
+                # HEAD not supported, only the headers of the GET are read
+                response = session.get('https://www.marches-publics.gouv.fr{}'.format(link_file), stream=True, headers=headers)
+                response.close()
+            if response.status_code != 200:
+                continue
+            content_length = response.headers.get('Content-Length')
+            if (
+                content_length is not None and 'Content-Encoding' not in response.headers
+                and int(content_length) != dce_data['file_size_{}'.format(file_type)]
+            ):
+                return True, fingerprint
+            if dce_data['filename_{}'.format(file_type)] not in response.headers.get('Content-Disposition', ''):
+                return True, fingerprint
+
+    return False, fingerprint
+
+
+def fetch_current_annonces(nb_pages=0, fetch_client=None):
     """fetch_current_annonces(): Fetch the list of currently available DCE.
 
     nb_pages: number of pages to fetch, 0 to set no limit (for example, you can set to 1 for a development setup)
+    fetch_client: FetchClient to use, a new one is created if None
 
     Returns a list of URL.
     """
-    links_by_page = []
+    return list(iter_current_annonces(nb_pages=nb_pages, fetch_client=fetch_client))
+
+
+def iter_current_annonces(nb_pages=0, fetch_client=None, known_annonce_ids=None, stop_after_known_pages=0, crawl_stats=None, checkpoint_path=None):
+    """iter_current_annonces(): Yield the currently available DCE as soon as their page is fetched.
+
+    nb_pages: number of pages to fetch, 0 to set no limit
+    fetch_client: FetchClient to use, a new one is created if None
+    known_annonce_ids: set of the annonce_id already in the database
+    stop_after_known_pages: stop after this number of consecutive pages containing only known DCE, 0 to never stop early
+    crawl_stats: if not None, dict filled with the number of pages and links of the crawl
+    checkpoint_path: if not None, the progress of the crawl is saved there after each page, and an interrupted crawl
+        resumes from its last good page
+
+    Yields each URL once, the DCE that appear on several pages are skipped after their first occurrence.
+    A page that fails because of the network or an unexpected status is retried, in a new PRADO session if needed.
+    PLACE answers 500 after the last page of results, but also when it fails. After a page with less than
+    LISTING_PAGE_SIZE results, a 500 is the end of the results. After a full page, the end is only accepted if the same
+    page is answered 500 again in a new PRADO session.
+    """
+    if fetch_client is None:
+        fetch_client = FetchClient()
+    if known_annonce_ids is None:
+        known_annonce_ids = set()
+    if crawl_stats is None:
+        crawl_stats = {}
+    session = fetch_client.new_session()
+
+    seen_links = set()
+    duplicates = set()
+    nb_new_links = 0
+    nb_known_pages = 0
+    complete = False
     page_state = None
-    cookie = None
     current_page_links = None
+    counter = 0
+    nb_failures = 0
+    resume_in_new_session = False
+    checking_end = False
+
+    checkpoint = load_checkpoint(checkpoint_path) if checkpoint_path else None
+    if checkpoint:
+        logging.info('Resuming the crawl after page {}'.format(checkpoint['page_number']))
+        counter = checkpoint['page_number']
+        page_state = checkpoint['page_state']
+        current_page_links = checkpoint['current_page_links']
+        for cookie in checkpoint['cookies']:
+            session.cookies.set(**cookie)
+        # The links of the interrupted crawl may not all have been downloaded, they are yielded again
+        for link in checkpoint['links']:
+            seen_links.add(link)
+            if annonce_id_from_link(link) not in known_annonce_ids:
+                nb_new_links += 1
+            yield link
+
     try:
-        counter = 0
         while (nb_pages == 0) or (counter < nb_pages):
-            current_page_links, page_state, cookie = next_page(page_state, cookie, current_page_links)
+            try:
+                if resume_in_new_session:
+                    # The page state has probably expired, start a new PRADO session and page up to where we were
+                    session = fetch_client.new_session()
+                    try:
+                        current_page_links, page_state = fast_forward(session, counter)
+                    except NoMoreResultsException as exception:
+                        # The results ended before the page we were at, the crawl is not complete
+                        raise PageFetchException('No more results while paging up to page {}'.format(counter)) from exception
+                    resume_in_new_session = False
+                with metrics.timer('fetch_listing_page_seconds'):
+                    current_page_links, page_state = next_page(session, page_state, current_page_links)
+            except ServerErrorException:
+                if checking_end or (current_page_links is not None and len(current_page_links) < LISTING_PAGE_SIZE):
+                    raise NoMoreResultsException()
+                logging.info('Status 500 after page {}, checking the end of the results in a new session'.format(counter))
+                metrics.count('fetch_listing_end_checks')
+                checking_end = True
+                resume_in_new_session = True
+                time.sleep(float(CONFIG_FETCH['retry_backoff']))
+                continue
+            except (requests.RequestException, PageFetchException) as exception:
+                # The failures while paging up to where we were count as attempts too
+                metrics.count('fetch_listing_page_retries')
+                nb_failures += 1
+                if nb_failures > int(CONFIG_FETCH['max_resume_attempts']):
+                    raise
+                logging.warning("Exception of type {} after page {}, retrying".format(type(exception).__name__, counter))
+                logging.debug("Exception details: {}".format(exception))
+                time.sleep(float(CONFIG_FETCH['retry_backoff']) * 2 ** nb_failures)
+                if nb_failures > 1:
+                    resume_in_new_session = True
+                continue
+
+            nb_failures = 0
+            checking_end = False
             logging.debug(f'Found {len(current_page_links)} new links')
-            links_by_page.append(current_page_links)
             counter += 1
 
+            page_has_new_links = False
+            for link in current_page_links:
+                if link in seen_links:
+                    duplicates.add(link)
+                    continue
+                seen_links.add(link)
+                if annonce_id_from_link(link) not in known_annonce_ids:
+                    page_has_new_links = True
+                    nb_new_links += 1
+                yield link
+
+            if checkpoint_path:
+                save_checkpoint(checkpoint_path, {
+                    'page_number': counter,
+                    'page_state': page_state,
+                    'current_page_links': current_page_links,
+                    'cookies': [
+                        {'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain, 'path': cookie.path}
+                        for cookie in session.cookies
+                    ],
+                    'links': sorted(seen_links),
+                })
+
+            nb_known_pages = 0 if page_has_new_links else nb_known_pages + 1
+            if stop_after_known_pages and nb_known_pages >= stop_after_known_pages:
+                logging.debug('Stopping after {} pages containing only known DCE'.format(nb_known_pages))
+                break
+
     except NoMoreResultsException:
-        pass
+        complete = True
 
-    all_links = []
-    for links in links_by_page:
-        all_links += links
-    if len(all_links) != len(set(all_links)):
-        duplicates = [k for k, v in Counter(all_links).items() if v > 1]
-        nb_duplicates = len(duplicates)
-        logging.info('{} DCE found multiple times'.format(nb_duplicates))
+    # The crawl went through, the next one starts from the first page
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
 
-    return all_links
+    crawl_stats.update({
+        'nb_pages': counter,
+        'nb_links': len(seen_links),
+        'nb_new_links': nb_new_links,
+        'nb_duplicates': len(duplicates),
+        'complete': complete,
+    })
 
+    logging.debug("{} links".format(len(seen_links)))
+    if duplicates:
+        logging.info('{} DCE found multiple times'.format(len(duplicates)))
 
-def fetch_data(link_annonce):
-    """fetch_data(): Fetch the metadata and the files of a given DCE.
+
+def annonce_id_from_link(link):
+    return LINK_REGEX.match(link).groups()[0]
+
+
+def fast_forward(session, nb_pages):
+    """fast_forward(): Page through a new PRADO session until nb_pages pages have been fetched.
+
+    Returns the links and the page state of the last page, (None, None) if nb_pages is 0.
+    """
+    links, page_state = None, None
+    for _ in range(nb_pages):
+        links, page_state = next_page(session, page_state, links)
+    return links, page_state
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    checkpoint = dict(checkpoint, saved_datetime=datetime.datetime.now().isoformat())
+    temporary_path = checkpoint_path + '.tmp'
+    with open(temporary_path, 'w', encoding='UTF-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(temporary_path, checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path):
+    """load_checkpoint(): Return the checkpoint of an interrupted crawl, None if there is none or if it is too old.
     """
+    if not os.path.exists(checkpoint_path):
+        return None
+
+    with open(checkpoint_path, 'r', encoding='UTF-8') as f:
+        checkpoint = json.load(f)
+
+    checkpoint_age = datetime.datetime.now() - datetime.datetime.fromisoformat(checkpoint['saved_datetime'])
+    if checkpoint_age > datetime.timedelta(hours=float(CONFIG_FETCH['checkpoint_max_age_hours'])):
+        logging.info('Ignoring the crawl checkpoint saved {} ago'.format(checkpoint_age))
+        return None
 
-    annonce_id, org_acronym = re.match(LINK_REGEX, link_annonce).groups()
+    return checkpoint
+
+
+def fetch_annonce_page(session, link_annonce):
+    """fetch_annonce_page(): Fetch the annonce page of a DCE, and return its recap fields and the links to its files.
+    """
 
-    response = requests.get(link_annonce, allow_redirects=False, timeout=600)
+    response = session.get(link_annonce, allow_redirects=False)
     assert response.status_code == 200
 
 
     # Get text data
 
-    links_boamp = extract_links(response, BOAMP_REGEX)
+    # The annonce page is parsed once, for the BOAMP links as well as for the recap fields and the files
+    soup = BeautifulSoup(response.text, HTML_PARSER)
+
+    links_boamp = filter_links(soup.find_all('a'), BOAMP_REGEX)
     unique_boamp = list(set(links_boamp))
     links_boamp = unique_boamp
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-
     recap_data = soup.find_all(class_="col-md-10 text-justify")
 
     assert recap_data[0].find('label').text.strip() == "Référence :"
@@ -157,7 +558,7 @@ def fetch_data(link_annonce):
     for link in file_links:
         link_href = link.attrs['href']
 
-        if re.match(BOAMP_REGEX, link_href):
+        if BOAMP_REGEX.match(link_href):
             continue
         if not link_href:
             continue
@@ -191,13 +592,64 @@ def fetch_data(link_annonce):
     assert len(links_complements) <= 1
     link_complement = links_complements[0] if links_complements else None
 
+    return {
+        'links_boamp': links_boamp,
+        'reference': reference,
+        'intitule': intitule,
+        'objet': objet,
+        'organisme': organisme,
+        'link_avis': link_avis,
+        'link_reglement': link_reglement,
+        'link_complement': link_complement,
+        'link_dce': link_dce,
+    }
+
+
+def annonce_fingerprint(annonce_page):
+    """annonce_fingerprint(): Hash of the recap fields and of the links to the files of an annonce page
+
+    An avis rectificatif or a new version of a file changes the page, see check_link().
+    """
+    annonce_page = dict(annonce_page, links_boamp=sorted(annonce_page['links_boamp']))
+    return hashlib.sha256(json.dumps(annonce_page, sort_keys=True).encode('UTF-8')).hexdigest()
+
 
-    def write_response_to_file(annonce_id, filename, file_type, response):
+def fetch_data(link_annonce, fetch_client=None, session=None, annonce_page=None):
+    """fetch_data(): Fetch the metadata and the files of a given DCE.
+
+    fetch_client: FetchClient to use, a new one is created if None
+    session, annonce_page: the session and the annonce page already fetched if any (see check_link()), None to fetch them
+    """
+
+    annonce_id, org_acronym = LINK_REGEX.match(link_annonce).groups()
+
+    if session is None:
+        if fetch_client is None:
+            fetch_client = FetchClient()
+        session = fetch_client.new_session()
+
+    if annonce_page is None:
+        annonce_page = fetch_annonce_page(session, link_annonce)
+    links_boamp = annonce_page['links_boamp']
+    reference = annonce_page['reference']
+    intitule = annonce_page['intitule']
+    objet = annonce_page['objet']
+    organisme = annonce_page['organisme']
+    link_avis = annonce_page['link_avis']
+    link_reglement = annonce_page['link_reglement']
+    link_complement = annonce_page['link_complement']
+    link_dce = annonce_page['link_dce']
+
+
+    digests = {}
+
+    def write_response_to_file(annonce_id, filename, file_type, response, open_response):
+        # The file is hashed as it is downloaded and stored once per content, see blob_store.
+        # open_response(headers) sends the request again, to resume the download if the connection drops.
         internal_filepath = build_internal_filepath(annonce_id=annonce_id, original_filename=filename, file_type=file_type)
-        with open(internal_filepath, 'wb') as file_object:
-            for chunk in response.iter_content(8192):
-                file_object.write(chunk)
-        return os.path.getsize(internal_filepath)
+        file_size, digests[file_type] = download(response, open_response, annonce_id, file_type, internal_filepath)
+        metrics.count('fetch_bytes_downloaded', file_size, file_type=file_type)
+        return file_size
 
 
     # Get avis
@@ -205,12 +657,13 @@ def fetch_data(link_annonce):
     filename_avis = None
     file_size_avis = None
     if link_avis:
-        response_avis = requests.get('https://www.marches-publics.gouv.fr{}'.format(link_avis), stream=True, timeout=600)
-        assert response_avis.status_code == 200
-        regex_attachment = r'^attachment; filename=([^;]+);'
-        filename_avis = re.match(regex_attachment, response_avis.headers['Content-Disposition']).groups()[0]
+        open_avis = lambda headers: session.get('https://www.marches-publics.gouv.fr{}'.format(link_avis), stream=True, headers=headers)
+        with open_download(open_avis, annonce_id, 'avis') as response_avis:
+            assert response_avis.status_code in (200, 206)
+            regex_attachment = r'^attachment; filename=([^;]+);'
+            filename_avis = re.match(regex_attachment, response_avis.headers['Content-Disposition']).groups()[0]
 
-        file_size_avis = write_response_to_file(annonce_id=annonce_id, filename=filename_avis, file_type='avis', response=response_avis)
+            file_size_avis = write_response_to_file(annonce_id=annonce_id, filename=filename_avis, file_type='avis', response=response_avis, open_response=open_avis)
 
 
     # Fetch reglement
@@ -219,14 +672,15 @@ def fetch_data(link_annonce):
     reglement_ref = None
     file_size_reglement = None
     if link_reglement:
-        reglement_ref = re.match(REGLEMENT_REGEX, link_reglement).groups()[0]
-        response_reglement = requests.get('https://www.marches-publics.gouv.fr{}'.format(link_reglement), stream=True, timeout=600)
-        assert response_reglement.status_code == 200
-        check_content_type(response_reglement.headers['Content-Type'], link_annonce)
-        regex_attachment = r'^attachment; filename="([^"]+)";$'
-        filename_reglement = re.match(regex_attachment, response_reglement.headers['Content-Disposition']).groups()[0]
+        reglement_ref = REGLEMENT_REGEX.match(link_reglement).groups()[0]
+        open_reglement = lambda headers: session.get('https://www.marches-publics.gouv.fr{}'.format(link_reglement), stream=True, headers=headers)
+        with open_download(open_reglement, annonce_id, 'reglement') as response_reglement:
+            assert response_reglement.status_code in (200, 206)
+            check_content_type(response_reglement.headers['Content-Type'], link_annonce)
+            regex_attachment = r'^attachment; filename="([^"]+)";$'
+            filename_reglement = re.match(regex_attachment, response_reglement.headers['Content-Disposition']).groups()[0]
 
-        file_size_reglement = write_response_to_file(annonce_id=annonce_id, filename=filename_reglement, file_type='reglement', response=response_reglement)
+            file_size_reglement = write_response_to_file(annonce_id=annonce_id, filename=filename_reglement, file_type='reglement', response=response_reglement, open_response=open_reglement)
 
 
     # Fetch complement
@@ -234,12 +688,13 @@ def fetch_data(link_annonce):
     filename_complement = None
     file_size_complement = None
     if link_complement:
-        response_complement = requests.get('https://www.marches-publics.gouv.fr{}'.format(link_complement), stream=True, timeout=600)
-        assert response_complement.status_code == 200
-        regex_attachment = r'^attachment; filename="([^"]+)"'
-        filename_complement = re.match(regex_attachment, response_complement.headers['Content-Disposition']).groups()[0]
+        open_complement = lambda headers: session.get('https://www.marches-publics.gouv.fr{}'.format(link_complement), stream=True, headers=headers)
+        with open_download(open_complement, annonce_id, 'complement') as response_complement:
+            assert response_complement.status_code in (200, 206)
+            regex_attachment = r'^attachment; filename="([^"]+)"'
+            filename_complement = re.match(regex_attachment, response_complement.headers['Content-Disposition']).groups()[0]
 
-        file_size_complement = write_response_to_file(annonce_id=annonce_id, filename=filename_complement, file_type='complement', response=response_complement)
+            file_size_complement = write_response_to_file(annonce_id=annonce_id, filename=filename_complement, file_type='complement', response=response_complement, open_response=open_complement)
 
 
     # Get Dossier de Consultation aux Entreprises
@@ -248,32 +703,36 @@ def fetch_data(link_annonce):
     file_size_dce = None
     if link_dce:
         url_dce = 'https://www.marches-publics.gouv.fr/index.php?page=Entreprise.EntrepriseDemandeTelechargementDce&id={}&orgAcronyme={}'.format(annonce_id, org_acronym)
-        response_dce = requests.get(url_dce, allow_redirects=False, timeout=600)
-        assert response_dce.status_code == 200
-        page_state = re.search(PAGE_STATE_REGEX, response_dce.text).groups()[0]
-        cookie = response_dce.headers['Set-Cookie']
-
-        data = {
-            'PRADO_PAGESTATE': page_state,
-            'PRADO_POSTBACK_TARGET': 'ctl0$CONTENU_PAGE$validateButton',
-            'ctl0$CONTENU_PAGE$EntrepriseFormulaireDemande$RadioGroup': 'ctl0$CONTENU_PAGE$EntrepriseFormulaireDemande$choixAnonyme',
-        }
-        response_dce2 = requests.post(url_dce, headers={'Cookie': cookie}, data=data, allow_redirects=False, timeout=600)
-        assert response_dce2.status_code == 200
-        page_state = re.search(PAGE_STATE_REGEX, response_dce2.text).groups()[0]
-
-        data = {
-            'PRADO_PAGESTATE': page_state,
-            'PRADO_POSTBACK_TARGET': 'ctl0$CONTENU_PAGE$EntrepriseDownloadDce$completeDownload',
-        }
-        response_dce3 = requests.post(url_dce, headers={'Cookie': cookie}, data=data, stream=True, timeout=600)
-        assert response_dce3.status_code == 200
-
-        check_content_type(response_dce3.headers['Content-Type'], link_annonce)
-        regex_attachment = r'^attachment; filename="([^"]+)";$'
-        filename_dce = re.match(regex_attachment, response_dce3.headers['Content-Disposition']).groups()[0]
-
-        file_size_dce = write_response_to_file(annonce_id=annonce_id, filename=filename_dce, file_type='dce', response=response_dce3)
+
+        def open_dce(headers):
+            # A PRADO postback cannot be replayed, resuming the download goes through the whole form again
+            response_dce = session.get(url_dce, allow_redirects=False)
+            assert response_dce.status_code == 200
+            page_state = PAGE_STATE_REGEX.search(response_dce.text).groups()[0]
+
+            data = {
+                'PRADO_PAGESTATE': page_state,
+                'PRADO_POSTBACK_TARGET': 'ctl0$CONTENU_PAGE$validateButton',
+                'ctl0$CONTENU_PAGE$EntrepriseFormulaireDemande$RadioGroup': 'ctl0$CONTENU_PAGE$EntrepriseFormulaireDemande$choixAnonyme',
+            }
+            response_dce2 = session.post(url_dce, data=data, allow_redirects=False)
+            assert response_dce2.status_code == 200
+            page_state = PAGE_STATE_REGEX.search(response_dce2.text).groups()[0]
+
+            data = {
+                'PRADO_PAGESTATE': page_state,
+                'PRADO_POSTBACK_TARGET': 'ctl0$CONTENU_PAGE$EntrepriseDownloadDce$completeDownload',
+            }
+            return session.post(url_dce, data=data, stream=True, headers=headers)
+
+        with open_download(open_dce, annonce_id, 'dce') as response_dce3:
+            assert response_dce3.status_code in (200, 206)
+
+            check_content_type(response_dce3.headers['Content-Type'], link_annonce)
+            regex_attachment = r'^attachment; filename="([^"]+)";$'
+            filename_dce = re.match(regex_attachment, response_dce3.headers['Content-Disposition']).groups()[0]
+
+            file_size_dce = write_response_to_file(annonce_id=annonce_id, filename=filename_dce, file_type='dce', response=response_dce3, open_response=open_dce)
 
 
     return {
@@ -293,64 +752,79 @@ def fetch_data(link_annonce):
         'file_size_complement': file_size_complement,
         'file_size_avis': file_size_avis,
         'file_size_dce': file_size_dce,
+        'sha256_reglement': digests.get('reglement'),
+        'sha256_complement': digests.get('complement'),
+        'sha256_avis': digests.get('avis'),
+        'sha256_dce': digests.get('dce'),
+        'fingerprint': annonce_fingerprint(annonce_page),
     }
 
 
 
-def init():
+def init(session):
     """init(): Fetch the first page of the row.
+
+    session: session of the listing crawl, it keeps the PRADO session cookie
     """
 
     # get page state
-    response = requests.get(URL_SEARCH, allow_redirects=False, timeout=600)
-    assert response.status_code == 200, response.status_code
-    page_state = re.search(PAGE_STATE_REGEX, response.text).groups()[0]
-    cookie = response.headers['Set-Cookie']
+    response = session.get(URL_SEARCH, allow_redirects=False)
+    if response.status_code != 200:
+        raise PageFetchException(response.status_code)
+    page_state = PAGE_STATE_REGEX.search(response.text).groups()[0]
 
     # use page with 20 results
     data = {
         'PRADO_PAGESTATE': page_state,
         'PRADO_POSTBACK_TARGET': 'ctl0$CONTENU_PAGE$resultSearch$listePageSizeTop',
-        'ctl0$CONTENU_PAGE$resultSearch$listePageSizeTop': 20,
+        'ctl0$CONTENU_PAGE$resultSearch$listePageSizeTop': LISTING_PAGE_SIZE,
     }
-    response = requests.post(
+    response = session.post(
         URL_SEARCH,
-        headers={'Cookie': cookie},
         data=data,
         allow_redirects=False,
-        timeout=600,
     )
-    assert response.status_code == 200, response.status_code
+    if response.status_code != 200:
+        raise PageFetchException(response.status_code)
     links = extract_links(response, LINK_REGEX)
-    page_state = re.search(PAGE_STATE_REGEX, response.text).groups()[0]
+    page_state = PAGE_STATE_REGEX.search(response.text).groups()[0]
 
-    return links, page_state, cookie
+    return links, page_state
 
 class NoMoreResultsException(Exception):
     pass
 
-def next_page(page_state, cookie, previous_links):
+class ServerErrorException(NoMoreResultsException):
+    """ServerErrorException: A page of the listing was answered with 500, which PLACE also does after the last page.
+    """
+    pass
+
+class PageFetchException(Exception):
+    """PageFetchException: A page of the listing was answered with an unexpected status code.
+    """
+    pass
+
+def next_page(session, page_state, previous_links):
     if not page_state:
-        return init()
+        return init(session)
 
     data = {
         'PRADO_PAGESTATE': page_state,
         'PRADO_POSTBACK_TARGET': 'ctl0$CONTENU_PAGE$resultSearch$PagerTop$ctl2',
     }
-    response = requests.post(
+    response = session.post(
         URL_SEARCH,
-        headers={'Cookie': cookie},
         data=data,
         allow_redirects=False,
-        timeout=600,
     )
 
     if response.status_code == 500:
-        raise NoMoreResultsException()
+        raise ServerErrorException()
 
-    assert response.status_code == 200
+    if response.status_code != 200:
+        raise PageFetchException(response.status_code)
     links = extract_links(response, LINK_REGEX)
-    page_state_new_results = re.search(PAGE_STATE_REGEX, response.text)
+    page_state_new_results = PAGE_STATE_REGEX.search(response.text)
     if not page_state_new_results:
         raise NoMoreResultsException()
     page_state_new = page_state_new_results.groups()[0]
@@ -361,16 +835,22 @@ def next_page(page_state, cookie, previous_links):
     if previous_links == links:
         raise NoMoreResultsException()
 
-    return links, page_state_new, cookie
+    return links, page_state_new
 
 
 
 def extract_links(request_result, regex):
+    """extract_links(): Return the href of the <a> tags of the response that match the compiled regex.
+
+    Only the <a> tags are turned into a tree, the rest of the page (including the page state) is skipped.
+    """
     page = request_result.text
-    soup = BeautifulSoup(page, 'html.parser')
-    links = soup.find_all('a')
+    soup = BeautifulSoup(page, HTML_PARSER, parse_only=SoupStrainer('a', href=True))
+    return filter_links(soup.find_all('a'), regex)
+
+def filter_links(links, regex):
     hrefs = [link.attrs['href'] for link in links if 'href' in link.attrs]
-    hrefs_clean = [href for href in hrefs if re.match(regex, href)]
+    hrefs_clean = [href for href in hrefs if regex.match(href)]
     return hrefs_clean
 
 def check_content_type(content_type, link):
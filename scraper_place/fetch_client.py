@@ -0,0 +1,132 @@
+"""fetch_client: HTTP client shared by the whole fetch pipeline
+
+Use FetchClient() once per run and FetchClient.new_session() for every sequence of requests that needs its own cookies
+(a listing crawl, the download of one annonce). All the sessions of a client share the same connection pool.
+"""
+
+import sys
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from scraper_place import metrics
+from scraper_place.config import CONFIG_FETCH
+from scraper_place.throttle import HostThrottle
+
+
+PLACE_URL = 'https://www.marches-publics.gouv.fr'
+
+
+class ThrottledSession(requests.Session):
+    """ThrottledSession: requests.Session that goes through a HostThrottle and has a default timeout.
+
+    The slot of a request sent with stream=True is held until its response is closed, so that the bodies read later
+    count in max_workers_per_host. The caller must close those responses (with response: ...).
+    """
+
+    def __init__(self, throttle, timeout, base_url=None):
+        super().__init__()
+        self.throttle = throttle
+        self.timeout = timeout
+        self.base_url = base_url
+
+    def request(self, method, url, **kwargs):
+        if self.base_url and url.startswith(PLACE_URL):
+            url = self.base_url + url[len(PLACE_URL):]
+        kwargs.setdefault('timeout', self.timeout)
+        slot = self.throttle.slot(url)
+        slot.__enter__()
+        try:
+            with metrics.timer('fetch_request_seconds', method=method.upper()):
+                response = super().request(method, url, **kwargs)
+        except BaseException:
+            slot.__exit__(*sys.exc_info())
+            raise
+        if kwargs.get('stream'):
+            release_on_close(response, slot)
+        else:
+            slot.__exit__(None, None, None)
+
+        # The retries of the HTTPAdapter are invisible to the caller, they are only counted here
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and retries.history:
+            metrics.count('fetch_retries', len(retries.history))
+        metrics.count('fetch_responses', status=response.status_code)
+        return response
+
+    def close(self):
+        # The adapters are shared with the other sessions of the FetchClient, FetchClient.close() closes them.
+        pass
+
+
+def release_on_close(response, slot):
+    """release_on_close(): Leave the throttle slot when the response is closed, once
+    """
+    lock = threading.Lock()
+    released = []
+    close = response.close
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            with lock:
+                if not released:
+                    released.append(True)
+                    slot.__exit__(None, None, None)
+
+    response.close = close_and_release
+
+
+class FetchClient:
+    """FetchClient: Own the keep-alive connection pool, the retry policy and the throttle of the fetch stage.
+
+    Defaults are read from the [fetch] section of config.ini.
+    base_url: if set, the requests to PLACE are sent to this url instead (for example a local stand-in server)
+    """
+
+    def __init__(self, max_workers=None, timeout=None, max_retries=None, retry_backoff=None, base_url=None):
+        if max_workers is None:
+            max_workers = int(CONFIG_FETCH['max_workers'])
+        if timeout is None:
+            timeout = float(CONFIG_FETCH['timeout'])
+        if max_retries is None:
+            max_retries = int(CONFIG_FETCH['max_retries'])
+        if retry_backoff is None:
+            retry_backoff = float(CONFIG_FETCH['retry_backoff'])
+
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.base_url = base_url
+        self.throttle = HostThrottle(
+            max_per_host=int(CONFIG_FETCH['max_workers_per_host']),
+            min_interval=float(CONFIG_FETCH['min_request_interval']),
+        )
+
+        # Only idempotent requests are retried: replaying a PRADO postback would desynchronize the page state.
+        # 500 is not retried either, PLACE answers 500 after the last page of results.
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=retry_backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=max_workers + 1,
+            max_retries=retry,
+        )
+
+    def new_session(self):
+        """new_session(): Return a session with an empty cookie jar, using the shared connection pool.
+        """
+        session = ThrottledSession(throttle=self.throttle, timeout=self.timeout, base_url=self.base_url)
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+        return session
+
+    def close(self):
+        self.adapter.close()
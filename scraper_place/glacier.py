@@ -3,78 +3,152 @@
 
 import os
 import logging
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from botocore.exceptions import ClientError
 from pymongo import MongoClient
-import boto3
 
-from scraper_place.config import CONFIG_S3, STATE_FETCH_OK, STATE_GLACIER_OK, STATE_GLACIER_KO, CONFIG_ENV, build_internal_filepath
+from scraper_place import metrics
+from scraper_place.schema import GLACIER_PROJECTION
+from scraper_place.config import CONFIG_S3, STATE_FETCH_OK, STATE_GLACIER_OK, CONFIG_ENV, build_internal_filepath, build_s3_client, build_transfer_config
 
 
-def save():
+def save(nb_workers=None):
     """save(): Save all the DCEs to AWS Glacier and keep their archive id in the database.
+
+    nb_workers: number of DCEs uploaded concurrently, read from the [s3] config if None.
+    Returns the number of DCEs saved.
     """
 
+    if nb_workers is None:
+        nb_workers = int(CONFIG_S3['nb_upload_workers'])
+
     client = MongoClient()
     collection = client.place.dce
 
-    s3_resource = boto3.session.Session(
-        aws_access_key_id=CONFIG_S3['aws_access_key_id'],
-        aws_secret_access_key=CONFIG_S3['aws_secret_access_key'],
-        region_name=CONFIG_S3['region_name'],
-    ).resource('s3')
-
-    cursor = collection.find({'state': STATE_FETCH_OK})
-    for dce_data in cursor:
-        save_dce(dce_data=dce_data, s3_resource=s3_resource, collection=collection)
+    s3_client = build_s3_client()
+    transfer_config = build_transfer_config()
+
+    # The ids are listed first, the workers may be slower than the cursor timeout
+    cursor = collection.find({'state': STATE_FETCH_OK}, {'annonce_id': True, '_id': False}).sort('fetch_datetime', 1)
+    annonce_ids = [dce_data['annonce_id'] for dce_data in cursor]
+
+    def save_annonce(annonce_id):
+        dce_data = collection.find_one({'annonce_id': annonce_id}, GLACIER_PROJECTION)
+        with metrics.timer('glacier_dce_seconds'):
+            return save_dce(dce_data=dce_data, s3_client=s3_client, collection=collection, transfer_config=transfer_config)
+
+    nb_saved = 0
+    nb_bytes = 0
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        futures = {executor.submit(save_annonce, annonce_id): annonce_id for annonce_id in annonce_ids}
+        for future in as_completed(futures):
+            try:
+                nb_bytes += future.result()
+                nb_saved += 1
+            except Exception as exception:
+                metrics.failure('glacier', exception)
+                # The DCE stays in fetch_ok, it will be saved by the next run
+                logging.warning("Exception of type {} while saving {} on AWS Glacier".format(type(exception).__name__, futures[future]))
+                logging.debug("Exception details: {}".format(exception))
+                logging.debug(traceback.format_exc())
+    elapsed = time.monotonic() - start
 
     client.close()
 
+    logging.info('Saved {} DCE on AWS Glacier, {:.1f} MB in {:.1f} s ({:.2f} MB/s)'.format(
+        nb_saved, nb_bytes / 1e6, elapsed, nb_bytes / 1e6 / elapsed if elapsed else 0))
+    metrics.count('glacier_dce_saved', nb_saved)
+    metrics.write_report('glacier')
+    return nb_saved
 
-def save_dce(dce_data, s3_resource, collection):
+
+def save_dce(dce_data, s3_client, collection, transfer_config=None):
     """save_dce(): Save one DCE to AWS Glacier
+
+    The files above the multipart threshold of transfer_config are uploaded in parts, which is also what allows files
+    larger than the 5 GB limit of a single upload.
+    Each uploaded file is recorded in glacier_files.{file_type} (key, size, etag), and the files already recorded or
+    already in the bucket with the same size are skipped: a DCE interrupted by a failure is resumed file by file.
+    The files with a sha256 are stored by content (see build_object_key), the ones shared by several DCE are uploaded once.
+    Returns the number of bytes uploaded.
     """
     annonce_id = dce_data['annonce_id']
     file_types = ['reglement', 'complement', 'avis', 'dce']
     filenames = [dce_data['filename_reglement'], dce_data['filename_complement'], dce_data['filename_avis'], dce_data['filename_dce']]
 
-    # Checks if the file is not too large to be uploaded using boto3 (max 4Go)
-    # If a file is that large, we probably don't want to backup nor index it.
+    if transfer_config is None:
+        transfer_config = build_transfer_config()
+
+    nb_bytes = 0
     for file_type, filename in zip(file_types, filenames):
         if not filename:
             continue
 
         internal_filepath = build_internal_filepath(annonce_id=annonce_id, original_filename=filename, file_type=file_type)
-
+        key = build_object_key(dce_data, file_type, internal_filepath)
         file_size = os.path.getsize(internal_filepath)
-        if file_size >= 4294967296:
-            logging.warning('{} is too large to be saved on AWS Glacier'.format(internal_filepath))
 
-            collection.update_one(
-                {'annonce_id': annonce_id},
-                {'$set': {'state': STATE_GLACIER_KO}},
-            )
-            return
-
-    for file_type, filename in zip(file_types, filenames):
-        if not filename:
+        uploaded_file = dce_data.get('glacier_files', {}).get(file_type)
+        if uploaded_file and uploaded_file['key'] == key and uploaded_file['size'] == file_size:
+            logging.debug('{} already saved on AWS S3 Glacier Deep Archive'.format(internal_filepath))
+            metrics.count('glacier_files_skipped')
             continue
 
-        internal_filepath = build_internal_filepath(annonce_id=annonce_id, original_filename=filename, file_type=file_type)
-        internal_filename = os.path.basename(internal_filepath)
-        logging.debug('Saving {} on AWS S3 Glacier Deep Archive...'.format(internal_filepath))
-        s3_resource.meta.client.upload_file(
-            Filename=internal_filepath,
-            Bucket=CONFIG_S3['dce_backup_bucket_name'],
-            Key=internal_filename,
-            ExtraArgs={'StorageClass': 'DEEP_ARCHIVE'}
+        uploaded_file = head_uploaded_file(s3_client, key)
+        if uploaded_file is None or uploaded_file['size'] != file_size:
+            logging.debug('Saving {} on AWS S3 Glacier Deep Archive...'.format(internal_filepath))
+            with metrics.timer('glacier_upload_seconds'):
+                s3_client.upload_file(
+                    Filename=internal_filepath,
+                    Bucket=CONFIG_S3['dce_backup_bucket_name'],
+                    Key=key,
+                    ExtraArgs={'StorageClass': 'DEEP_ARCHIVE'},
+                    Config=transfer_config,
+                )
+            nb_bytes += file_size
+            metrics.count('glacier_bytes_uploaded', file_size)
+            uploaded_file = head_uploaded_file(s3_client, key)
+        else:
+            logging.debug('{} found on AWS S3 Glacier Deep Archive, not uploaded again'.format(internal_filepath))
+            metrics.count('glacier_files_skipped')
+
+        collection.update_one(
+            {'annonce_id': annonce_id},
+            {'$set': {'glacier_files.{}'.format(file_type): uploaded_file}, '$currentDate': {'last_modified': True}},
         )
 
     collection.update_one(
         {'annonce_id': annonce_id},
-        {'$set': {'state': STATE_GLACIER_OK}},
+        {'$set': {'state': STATE_GLACIER_OK}, '$currentDate': {'last_modified': True}},
     )
 
     logging.debug('Saved {} on AWS Glavier'.format(annonce_id))
+    return nb_bytes
+
+
+def build_object_key(dce_data, file_type, internal_filepath):
+    """build_object_key(): Key of a file in the DCE bucket, by content if the file was stored by blob_store
+    """
+    digest = dce_data.get('sha256_{}'.format(file_type))
+    if digest:
+        return 'sha256/{}'.format(digest)
+    return os.path.basename(internal_filepath)
+
+
+def head_uploaded_file(s3_client, key):
+    """head_uploaded_file(): Return the key, size and etag of a file in the DCE bucket, None if it is not there
+    """
+    try:
+        response = s3_client.head_object(Bucket=CONFIG_S3['dce_backup_bucket_name'], Key=key)
+    except ClientError as exception:
+        if exception.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return {'key': key, 'size': response['ContentLength'], 'etag': response['ETag'].strip('"')}
 
 if __name__ == '__main__':
     save()
@@ -4,40 +4,224 @@ Make sure an ElasticSearch server is running.
 """
 
 import gzip
+import logging
+import time
+import traceback
 
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 import requests
-from elasticsearch import Elasticsearch
+from elasticsearch import ConflictError, Elasticsearch, helpers
 
+from scraper_place import metrics
+from scraper_place.schema import INDEXATION_PROJECTION
 from scraper_place.config import CONFIG_ELASTICSEARCH, CONFIG_ENV, STATE_CONTENT_EXTRACTION_OK, STATE_CONTENT_INDEXATION_OK, build_extract_filepath
 
 
 def index():
     """index(): Extract content from all DCE and index it in ElasticSearch.
+
+    The DCE are read from a single cursor and sent with the _bulk API, in chunks capped in number of documents and in
+    bytes (see the [elasticsearch] config). The states are updated in mongo by batches as well.
+    If index_passages is set, the content is indexed as passages in the passage index (see iter_passages()).
+    The DCE fetched again because they changed (see fetch.check_link()) replace their previous documents.
+    A DCE whose document already exists (indexed by a run interrupted before its state was saved) is marked as indexed.
     """
 
-    while True:
-        client = MongoClient()
-        collection = client.place.dce
-        dce_list = list(collection.find({'state': STATE_CONTENT_EXTRACTION_OK}).limit(1))
+    client = MongoClient()
+    collection = client.place.dce
+    es_client = build_es_client()
 
-        if not dce_list:
-            client.close()
-            break
+    if CONFIG_ELASTICSEARCH['index_passages'] == 'true':
+        # The new version of a DCE may have less passages than the previous one
+        cursor = collection.find({'state': STATE_CONTENT_EXTRACTION_OK, 'refetched': True}, {'annonce_id': True})
+        delete_passages(es_client, [dce_data['annonce_id'] for dce_data in cursor])
 
-        dce_data = dce_list[0]
-        client.close()
+    bulk_chunk_size = int(CONFIG_ELASTICSEARCH['bulk_chunk_size'])
+    cursor = collection.find({'state': STATE_CONTENT_EXTRACTION_OK}, INDEXATION_PROJECTION)
+
+    state_updates = []
+    failed_annonce_ids = set()
+    nb_indexed = 0
+    start = time.perf_counter()
+    results = helpers.streaming_bulk(
+        es_client,
+        iter_index_actions(cursor),
+        chunk_size=bulk_chunk_size,
+        max_chunk_bytes=int(float(CONFIG_ELASTICSEARCH['bulk_max_chunk_mb']) * 1000000),
+        raise_on_error=False,
+        max_retries=3,
+    )
+    for is_ok, result in results:
+        op_type, item = result.popitem()
+        if not is_ok and op_type == 'create' and is_version_conflict(item):
+            is_ok = True
+        metrics.count('indexation_documents', index=item['_index'], result='ok' if is_ok else 'error')
+        if not is_ok:
+            error = item.get('error')
+            metrics.count('indexation_failures', exception_type=error.get('type') if isinstance(error, dict) else 'unknown')
+
+        if item['_index'] == CONFIG_ELASTICSEARCH['passage_index_name']:
+            # The passages of a DCE are sent before its main document
+            if not is_ok:
+                annonce_id = item['_id'].rsplit('-', 1)[0]
+                logging.warning('Could not index passage {}: {}'.format(item['_id'], item.get('error')))
+                failed_annonce_ids.add(annonce_id)
+            continue
+
+        annonce_id = item['_id']
+        if not is_ok:
+            logging.warning('Could not index DCE {}: {}'.format(annonce_id, item.get('error')))
+            continue
+        if annonce_id in failed_annonce_ids:
+            failed_annonce_ids.remove(annonce_id)
+            continue
+
+        state_updates.append(UpdateOne({'annonce_id': annonce_id}, {'$set': {'state': STATE_CONTENT_INDEXATION_OK}, '$unset': {'refetched': ''}, '$currentDate': {'last_modified': True}}))
+        nb_indexed += 1
+        if len(state_updates) >= bulk_chunk_size:
+            collection.bulk_write(state_updates, ordered=False)
+            state_updates = []
+
+    if state_updates:
+        collection.bulk_write(state_updates, ordered=False)
+
+    logging.info('Indexed {} DCE'.format(nb_indexed))
+    metrics.count('indexation_dce_indexed', nb_indexed)
+    metrics.observe('indexation_run_seconds', time.perf_counter() - start)
+    client.close()
+    metrics.write_report('indexation')
+
+def is_version_conflict(item):
+    """is_version_conflict(): Tell whether a _bulk item failed because the document already exists
+    """
+    error = item.get('error')
+    return item.get('status') == 409 and isinstance(error, dict) and error.get('type') == 'version_conflict_engine_exception'
+
+def build_es_client():
+    return Elasticsearch(
+        [CONFIG_ELASTICSEARCH['elasticsearch_server_url']],
+        request_timeout=60,
+    )
+
+def iter_index_actions(dce_cursor):
+    """iter_index_actions(): Yield the _bulk actions creating the documents of the DCE of the cursor
+
+    With index_passages, the passages of a DCE are yielded before its main document.
+    A DCE whose extract cannot be read is logged and skipped.
+    """
+    index_passages = CONFIG_ELASTICSEARCH['index_passages'] == 'true'
+
+    for dce_data in dce_cursor:
+        try:
+            document = build_document(dce_data, with_content=not index_passages)
+            if index_passages:
+                yield from iter_passage_actions(dce_data)
+        except Exception as exception:
+            logging.warning("Exception of type {} occured, not indexing DCE {}".format(type(exception).__name__, dce_data['annonce_id']))
+            logging.debug("Exception details: {}".format(exception))
+            logging.debug(traceback.format_exc())
+            continue
+
+        yield {
+            # With passages, a DCE whose passages failed is sent again next time, its main document included.
+            # A DCE fetched again replaces its previous version.
+            '_op_type': 'index' if index_passages or dce_data.get('refetched') else 'create',
+            '_index': CONFIG_ELASTICSEARCH['index_name'],
+            '_id': '{}'.format(dce_data['annonce_id']),
+            '_source': document,
+        }
+
+def delete_passages(es_client, annonce_ids):
+    """delete_passages(): Delete the passages of the given DCE from the passage index
+    """
+    if not annonce_ids:
+        return
+    es_client.delete_by_query(
+        index=CONFIG_ELASTICSEARCH['passage_index_name'],
+        query={'terms': {'annonce_id': annonce_ids}},
+        conflicts='proceed',
+        refresh=True,
+    )
+
+def iter_passage_actions(dce_data):
+    annonce_id = dce_data['annonce_id']
+    passages = iter_passages(build_extract_filepath(annonce_id), int(CONFIG_ELASTICSEARCH['passage_size']))
+    for position, passage in enumerate(passages):
+        yield {
+            '_op_type': 'index',
+            '_index': CONFIG_ELASTICSEARCH['passage_index_name'],
+            '_id': '{}-{}'.format(annonce_id, position),
+            '_source': {
+                'annonce_id': annonce_id,
+                'position': position,
+                'content': passage,
+            },
+        }
+
+def iter_passages(extract_filepath, passage_size):
+    """iter_passages(): Yield the content of an extract file as passages of at most passage_size characters
 
-        index_dce(dce_data=dce_data)
+    Passages are cut after a line break when there is one in their second half. The extract file is read
+    progressively, so the memory used does not depend on the size of the content.
+    """
+    with gzip.open(extract_filepath, 'rt', encoding='UTF-8') as f:
+        buffer = ''
+        while True:
+            block = f.read(passage_size)
+            buffer += block
+            while len(buffer) > passage_size:
+                cut = buffer.rfind('\n', passage_size // 2, passage_size) + 1 or passage_size
+                passage, buffer = buffer[:cut], buffer[cut:]
+                if passage.strip():
+                    yield passage
+            if not block:
+                break
+        if buffer.strip():
+            yield buffer
 
-def index_dce(dce_data):
+def index_dce(dce_data, es_client=None, collection=None):
     """index_dce(): Index the content of one DCE using ElasticSearch
     """
 
     annonce_id = dce_data['annonce_id']
+    index_passages = CONFIG_ELASTICSEARCH['index_passages'] == 'true'
+    data = build_document(dce_data, with_content=not index_passages)
 
-    with gzip.open(build_extract_filepath(annonce_id), 'rt', encoding='UTF-8') as f:
-        content = f.read()
+    if es_client is None:
+        es_client = build_es_client()
+    with metrics.timer('indexation_dce_seconds'):
+        if index_passages:
+            if dce_data.get('refetched'):
+                delete_passages(es_client, [annonce_id])
+            helpers.bulk(es_client, iter_passage_actions(dce_data), max_chunk_bytes=int(float(CONFIG_ELASTICSEARCH['bulk_max_chunk_mb']) * 1000000))
+        # A DCE fetched again replaces its previous version
+        index_document = es_client.index if dce_data.get('refetched') else es_client.create
+        try:
+            index_document(
+                index=CONFIG_ELASTICSEARCH['index_name'],
+                id='{}'.format(dce_data['annonce_id']),
+                document=data,
+                timeout='60s',
+            )
+        except ConflictError:
+            # Indexed by a run interrupted before its state was saved
+            logging.debug('DCE {} already indexed'.format(annonce_id))
+    metrics.count('indexation_dce_indexed')
+
+    client = None
+    if collection is None:
+        client = MongoClient()
+        collection = client.place.dce
+    collection.update_one(
+        {'annonce_id': annonce_id},
+        {'$set': {'state': STATE_CONTENT_INDEXATION_OK}, '$unset': {'refetched': ''}, '$currentDate': {'last_modified': True}}
+    )
+    if client is not None:
+        client.close()
+
+def build_document(dce_data, with_content=True):
+    """build_document(): Build the ElasticSearch document of a DCE, with the content of its extract if with_content
+    """
 
     data = {
         'annonce_id': dce_data['annonce_id'],
@@ -61,27 +245,80 @@ def index_dce(dce_data):
         'embedded_filenames_complement': dce_data.get('embedded_filenames_complement'),
         'embedded_filenames_avis': dce_data.get('embedded_filenames_avis'),
         'embedded_filenames_dce': dce_data.get('embedded_filenames_dce'),
-        'content': content
     }
 
-    es_client = Elasticsearch(
-        [CONFIG_ELASTICSEARCH['elasticsearch_server_url']],
-        request_timeout=60,
-    )
-    es_client.create(
-        index=CONFIG_ELASTICSEARCH['index_name'],
-        id='{}'.format(dce_data['annonce_id']),
-        document=data,
-        timeout='60s',
+    if with_content:
+        with gzip.open(build_extract_filepath(dce_data['annonce_id']), 'rt', encoding='UTF-8') as f:
+            data['content'] = f.read()
+
+    return data
+
+def create_passage_index(es_client=None):
+    """create_passage_index(): Create the passage index (see index_passages in the [elasticsearch] config)
+    """
+
+    if es_client is None:
+        es_client = build_es_client()
+    es_client.indices.create(
+        index=CONFIG_ELASTICSEARCH['passage_index_name'],
+        settings={
+            'index': {
+                'number_of_shards': 5,
+                'number_of_replicas': 0,
+            },
+        },
+        mappings={
+            'properties': {
+                'annonce_id': {'type': 'keyword'},
+                'position': {'type': 'integer'},
+                'content': {
+                    'type': 'text',
+                    'term_vector': 'with_positions_offsets',
+                },
+            },
+        },
     )
 
-    client = MongoClient()
-    collection = client.place.dce
-    collection.update_one(
-        {'annonce_id': annonce_id},
-        {'$set': {'state': STATE_CONTENT_INDEXATION_OK}}
+def search_passages(query, size=20, nb_passages=3, es_client=None):
+    """search_passages(): Search the passage index and group the hits by DCE
+
+    Returns the number of matching DCE, and for the size best DCE, their annonce_id, their score and the highlighted
+    fragments of their nb_passages best passages.
+    """
+
+    if es_client is None:
+        es_client = build_es_client()
+    response = es_client.search(
+        index=CONFIG_ELASTICSEARCH['passage_index_name'],
+        query={'match': {'content': query}},
+        collapse={
+            'field': 'annonce_id',
+            'inner_hits': {
+                'name': 'best_passages',
+                'size': nb_passages,
+                '_source': False,
+                'highlight': {'fields': {'content': {}}},
+            },
+        },
+        aggs={'nb_annonces': {'cardinality': {'field': 'annonce_id'}}},
+        source=['annonce_id'],
+        size=size,
     )
-    client.close()
+
+    results = []
+    for hit in response['hits']['hits']:
+        passages = [
+            fragment
+            for passage_hit in hit['inner_hits']['best_passages']['hits']['hits']
+            for fragment in passage_hit.get('highlight', {}).get('content', [])
+        ]
+        results.append({
+            'annonce_id': hit['_source']['annonce_id'],
+            'score': hit['_score'],
+            'passages': passages,
+        })
+
+    return response['aggregations']['nb_annonces']['value'], results
 
 if __name__ == '__main__':
     index()
@@ -0,0 +1,222 @@
+"""metadata: Back up and restore the metadata of the DCEs (the place.dce collection)
+
+The backups are gzipped NDJSON files: one document per line, in MongoDB extended JSON. They are written and read one
+document at a time, so the memory used does not grow with the collection.
+
+Use backup() to make a full snapshot or, between two snapshots, an incremental backup of the documents inserted or
+modified since the previous backup, and restore() to replay the last snapshot and the incremental backups after it.
+"""
+
+import datetime
+import gzip
+import logging
+import os
+import re
+import threading
+
+from bson import json_util
+from pymongo import ReplaceOne
+
+from scraper_place.config import CONFIG_BACKUP, CONFIG_FILE_STORAGE, CONFIG_S3, build_s3_client, build_transfer_config
+
+
+BACKUP_KIND_FULL = 'full'
+BACKUP_KIND_INCREMENTAL = 'incremental'
+# The keys sort in chronological order
+BACKUP_KEY_REGEX = re.compile(r'^metadata-\d{4}-\d{2}-\d{2}T\d{2}-\d{2}-\d{2}-(full|incremental)\.ndjson\.gz$')
+
+
+def backup(collection, backups_collection):
+    """backup: Back up the collection, fully or incrementally, and record the backup in backups_collection
+
+    An incremental backup contains the documents fetched (fetch_datetime) or updated (last_modified, set by the stages)
+    since the start of the previous backup. A document modified during a backup is in this backup and the next one.
+    Returns the record of the backup.
+    """
+
+    start_datetime = datetime.datetime.now()
+    start_utc_datetime = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+    last_full_backup = backups_collection.find_one({'kind': BACKUP_KIND_FULL}, sort=[('start_datetime', -1)])
+    full_snapshot_interval = datetime.timedelta(days=float(CONFIG_BACKUP['full_snapshot_interval_days']))
+    if last_full_backup is None or start_datetime - last_full_backup['start_datetime'] >= full_snapshot_interval:
+        kind = BACKUP_KIND_FULL
+        query = None
+    else:
+        kind = BACKUP_KIND_INCREMENTAL
+        last_backup = backups_collection.find_one({}, sort=[('start_datetime', -1)])
+        query = {'$or': [
+            {'last_modified': {'$gte': last_backup['start_utc_datetime']}},
+            {'fetch_datetime': {'$gte': last_backup['start_datetime']}},
+        ]}
+
+    key = 'metadata-{}-{}.ndjson.gz'.format(start_datetime.strftime('%Y-%m-%dT%H-%M-%S'), kind)
+    nb_documents = backup_metadata(
+        collection=collection,
+        file_path=os.path.join(CONFIG_FILE_STORAGE['metadata_dir'], key),
+        key=key,
+        query=query,
+    )
+
+    backup_data = {
+        'key': key,
+        'kind': kind,
+        'start_datetime': start_datetime,
+        'start_utc_datetime': start_utc_datetime,
+        'end_datetime': datetime.datetime.now(),
+        'nb_documents': nb_documents,
+    }
+    backups_collection.insert_one(backup_data)
+    return backup_data
+
+
+def restore(collection):
+    """restore: Restore the last full snapshot of the metadata bucket into collection, then the incremental backups after it
+
+    The list of the backups is read from the bucket, not from the backups collection which may be lost as well.
+    Returns the keys of the backups restored.
+    """
+
+    s3_client = build_s3_client()
+    keys = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=CONFIG_S3['metadata_backup_bucket_name'], Prefix='metadata-'):
+        keys.extend(item['Key'] for item in page.get('Contents', []) if BACKUP_KEY_REGEX.match(item['Key']))
+    keys.sort()
+
+    full_keys = [key for key in keys if key.endswith('-{}.ndjson.gz'.format(BACKUP_KIND_FULL))]
+    if not full_keys:
+        raise Exception('No full snapshot in {}'.format(CONFIG_S3['metadata_backup_bucket_name']))
+    keys = keys[keys.index(full_keys[-1]):]
+
+    for i, key in enumerate(keys):
+        response = s3_client.get_object(Bucket=CONFIG_S3['metadata_backup_bucket_name'], Key=key)
+        # The incremental backups replace the documents restored before them
+        nb_documents = import_metadata(collection, response['Body'], replace=i > 0)
+        logging.info('Restored {} documents from {}'.format(nb_documents, key))
+    return keys
+
+
+def export_metadata(collection, file_object, query=None, batch_size=1000):
+    """export_metadata: Write the documents matching query (all if None) to a binary file object, as gzipped NDJSON
+
+    Returns the number of documents written.
+    """
+
+    nb_documents = 0
+    with gzip.GzipFile(fileobj=file_object, mode='wb') as gzip_file:
+        for document in collection.find(query if query is not None else {}, batch_size=batch_size):
+            gzip_file.write(json_util.dumps(document).encode('UTF-8'))
+            gzip_file.write(b'\n')
+            nb_documents += 1
+    return nb_documents
+
+
+def backup_metadata(collection, file_path, key, query=None):
+    """backup_metadata: Export the metadata to file_path and upload it to the metadata bucket at the same time
+
+    The export goes through a pipe to a multipart upload, the file is never read back nor held in memory.
+    Returns the number of documents exported.
+    """
+
+    s3_client = build_s3_client()
+    read_fd, write_fd = os.pipe()
+    export_complete = threading.Event()
+    upload_errors = []
+
+    def upload():
+        with os.fdopen(read_fd, 'rb') as reader:
+            try:
+                s3_client.upload_fileobj(
+                    PipeReader(reader, export_complete),
+                    Bucket=CONFIG_S3['metadata_backup_bucket_name'],
+                    Key=key,
+                    ExtraArgs={'StorageClass': 'ONEZONE_IA'},
+                    Config=build_transfer_config(),
+                )
+            except Exception as exception:
+                upload_errors.append(exception)
+
+    upload_thread = threading.Thread(target=upload)
+    upload_thread.start()
+    try:
+        with open(file_path, 'wb') as local_file, os.fdopen(write_fd, 'wb') as pipe:
+            nb_documents = export_metadata(collection, TeeFile(local_file, pipe), query=query)
+            export_complete.set()
+    except BrokenPipeError:
+        # The upload stopped reading, its exception is raised below
+        pass
+    finally:
+        upload_thread.join()
+    if upload_errors:
+        raise upload_errors[0]
+
+    logging.info('Backed up {} documents to {}'.format(nb_documents, key))
+    return nb_documents
+
+
+def import_metadata(collection, file_object, batch_size=1000, replace=False):
+    """import_metadata: Insert the documents of a backup (binary file object) into collection, batch_size at a time
+
+    replace: replace the documents with the same annonce_id instead of inserting, for the incremental backups
+    The former backups, a single JSON array, are still accepted but loaded at once.
+    Returns the number of documents imported.
+    """
+
+    def write(batch):
+        if replace:
+            collection.bulk_write([ReplaceOne({'annonce_id': document['annonce_id']}, document, upsert=True) for document in batch], ordered=False)
+        else:
+            collection.insert_many(batch)
+
+    nb_documents = 0
+    batch = []
+    with gzip.open(file_object, 'rt', encoding='UTF-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if line.startswith('['):
+                batch.extend(json_util.loads(line))
+            else:
+                batch.append(json_util.loads(line))
+            if len(batch) >= batch_size:
+                write(batch)
+                nb_documents += len(batch)
+                batch = []
+    if batch:
+        write(batch)
+        nb_documents += len(batch)
+    return nb_documents
+
+
+class PipeReader:
+    """PipeReader: Read end of the export pipe, failing the upload if the pipe is closed before the export is complete
+
+    Otherwise an interrupted export would be uploaded as a truncated backup.
+    """
+
+    def __init__(self, file_object, complete):
+        self.file_object = file_object
+        self.complete = complete
+
+    def read(self, size=-1):
+        data = self.file_object.read(size)
+        if not data and not self.complete.is_set():
+            raise IOError('The export was interrupted')
+        return data
+
+
+class TeeFile:
+    """TeeFile: Binary file object writing to several file objects
+    """
+
+    def __init__(self, *file_objects):
+        self.file_objects = file_objects
+
+    def write(self, data):
+        for file_object in self.file_objects:
+            file_object.write(data)
+        return len(data)
+
+    def flush(self):
+        for file_object in self.file_objects:
+            file_object.flush()
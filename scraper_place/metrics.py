@@ -0,0 +1,211 @@
+"""metrics: Count and time what the stages do, and report it at the end of each stage
+
+The stages record their metrics with count(), observe(), timer(), gauge_add() and failure(). The name of a metric
+starts with its stage (fetch_, glacier_, extraction_, indexation_, pipeline_), write_report(stage) writes the metrics
+of the stage to a JSON file in report_dir and resets them.
+If prometheus_textfile is set, it is rewritten with the last report of each stage, in the Prometheus text format (for
+the textfile collector of node_exporter).
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+
+from scraper_place.config import CONFIG_METRICS
+
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+PROMETHEUS_PREFIX = 'scraper_place_'
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_last_reports = {}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+        self.max = None
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+            'buckets': dict(zip([str(bound) for bound in self.buckets], self.bucket_counts)),
+        }
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def count(name, value=1, **labels):
+    """count: Add value to a counter (requests, bytes, retries...)
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=SECONDS_BUCKETS, **labels):
+    """observe: Add a value to a histogram (latency, queue depth...)
+    """
+    key = _key(name, labels)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram(buckets)
+        _histograms[key].observe(value)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """timer: Observe the duration of the with block in seconds, including when it raises
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def gauge_add(name, value, **labels):
+    """gauge_add: Add value to a gauge (items in flight...), its maximum is reported as well
+    """
+    key = _key(name, labels)
+    with _lock:
+        current, maximum = _gauges.get(key, (0, 0))
+        current += value
+        _gauges[key] = (current, max(maximum, current))
+
+
+def failure(stage, exception):
+    """failure: Count a failure of the stage by exception type
+    """
+    count('{}_failures'.format(stage), exception_type=type(exception).__name__)
+
+
+def write_report(stage):
+    """write_report: Write the metrics of the stage to report_dir, update the Prometheus textfile, and reset them
+
+    Returns the report.
+    """
+
+    prefix = stage + '_'
+    with _lock:
+        counters = {key: _counters.pop(key) for key in list(_counters) if key[0].startswith(prefix)}
+        histograms = {key: _histograms.pop(key) for key in list(_histograms) if key[0].startswith(prefix)}
+        gauges = {key: _gauges.pop(key) for key in list(_gauges) if key[0].startswith(prefix)}
+
+    end_datetime = datetime.datetime.now()
+    report = {
+        'stage': stage,
+        'end_datetime': end_datetime.isoformat(),
+        'counters': [
+            {'name': name, 'labels': dict(labels), 'value': value}
+            for (name, labels), value in sorted(counters.items())
+        ],
+        'histograms': [
+            {'name': name, 'labels': dict(labels), **histogram.as_dict()}
+            for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0])
+        ],
+        'gauges': [
+            {'name': name, 'labels': dict(labels), 'value': current, 'max': maximum}
+            for (name, labels), (current, maximum) in sorted(gauges.items())
+        ],
+    }
+
+    # The stage is done, a report that cannot be written must not make it fail
+    if CONFIG_METRICS['report_dir']:
+        report_path = os.path.join(CONFIG_METRICS['report_dir'], '{}-{}.json'.format(stage, end_datetime.strftime('%Y-%m-%dT%H-%M-%S')))
+        try:
+            with open(report_path, 'w', encoding='UTF-8') as f:
+                json.dump(report, f, indent=1)
+            logging.debug('Wrote the metrics of {} to {}'.format(stage, report_path))
+        except OSError as exception:
+            log_write_failure(exception, report_path)
+
+    if CONFIG_METRICS['prometheus_textfile']:
+        with _lock:
+            _last_reports[stage] = (counters, histograms, gauges)
+            lines = format_prometheus(_last_reports.values())
+        # The collector may read the file at any time, it is replaced at once
+        temporary_path = CONFIG_METRICS['prometheus_textfile'] + '.tmp'
+        try:
+            with open(temporary_path, 'w', encoding='UTF-8') as f:
+                f.write(''.join(line + '\n' for line in lines))
+            os.replace(temporary_path, CONFIG_METRICS['prometheus_textfile'])
+        except OSError as exception:
+            log_write_failure(exception, CONFIG_METRICS['prometheus_textfile'])
+
+    return report
+
+
+def log_write_failure(exception, path):
+    logging.warning("Exception of type {} while writing the metrics to {}".format(type(exception).__name__, path))
+    logging.debug("Exception details: {}".format(exception))
+    logging.debug(traceback.format_exc())
+
+
+def format_prometheus(reports):
+    """format_prometheus: Return the lines of the Prometheus text format for (counters, histograms, gauges) tuples
+    """
+
+    def format_labels(labels, **extra_labels):
+        labels = list(labels) + list(extra_labels.items())
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels) + '}'
+
+    lines = []
+    for counters, histograms, gauges in reports:
+        for name in sorted({name for name, _ in counters}):
+            lines.append('# TYPE {}{}_total counter'.format(PROMETHEUS_PREFIX, name))
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append('{}{}_total{} {}'.format(PROMETHEUS_PREFIX, name, format_labels(labels), value))
+
+        for name in sorted({name for name, _ in histograms}):
+            lines.append('# TYPE {}{} histogram'.format(PROMETHEUS_PREFIX, name))
+            for (histogram_name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+                if histogram_name != name:
+                    continue
+                cumulative_count = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append('{}{}_bucket{} {}'.format(PROMETHEUS_PREFIX, name, format_labels(labels, le=bound), cumulative_count))
+                lines.append('{}{}_bucket{} {}'.format(PROMETHEUS_PREFIX, name, format_labels(labels, le='+Inf'), histogram.count))
+                lines.append('{}{}_sum{} {}'.format(PROMETHEUS_PREFIX, name, format_labels(labels), histogram.sum))
+                lines.append('{}{}_count{} {}'.format(PROMETHEUS_PREFIX, name, format_labels(labels), histogram.count))
+
+        for name in sorted({name for name, _ in gauges}):
+            lines.append('# TYPE {}{} gauge'.format(PROMETHEUS_PREFIX, name))
+            lines.append('# TYPE {}{}_max gauge'.format(PROMETHEUS_PREFIX, name))
+            for (gauge_name, labels), (current, maximum) in sorted(gauges.items()):
+                if gauge_name == name:
+                    lines.append('{}{}{} {}'.format(PROMETHEUS_PREFIX, name, format_labels(labels), current))
+                    lines.append('{}{}_max{} {}'.format(PROMETHEUS_PREFIX, name, format_labels(labels), maximum))
+    return lines
@@ -0,0 +1,329 @@
+"""pipeline: Run the nightly stages without taking the search offline
+
+Use run() to fetch, archive, extract and index the new DCEs. Elasticsearch and the web app keep running: Tika is only
+started if the memory left by Elasticsearch allows it, with a number of extraction workers fitting the memory budget,
+and the new documents become searchable all at once when the indexation is over.
+
+Use run_streaming() to overlap the stages instead: each DCE goes to the next stage as soon as the previous one is done
+with it, and becomes searchable minutes after its download.
+"""
+
+import datetime
+import logging
+import queue
+import subprocess
+import threading
+import time
+import traceback
+import urllib.parse
+
+import requests
+from pymongo import MongoClient
+
+from scraper_place import extraction, fetch, glacier, indexation, metrics, schema
+from scraper_place.config import CONFIG_ELASTICSEARCH, CONFIG_PIPELINE, CONFIG_TIKA, STATE_CONTENT_EXTRACTION_OK, STATE_FETCH_OK, STATE_GLACIER_OK, build_s3_client, build_s3_resource, build_transfer_config
+
+
+def run():
+    """run(): Run all the stages, one after the other.
+    """
+
+    client = MongoClient()
+    schema.ensure_indexes(client.place)
+    client.close()
+
+    fetch.fetch_new_dce()
+    glacier.save()
+    run_extraction()
+    run_indexation()
+
+
+def run_extraction():
+    """run_extraction(): Start Tika if needed, extract the new DCEs with as many workers as the memory allows, stop Tika.
+
+    If there is not enough memory for Tika, the extraction is postponed: the DCEs stay in glacier_ok for the next run.
+    """
+
+    nb_workers = extraction_workers_for_budget()
+    if nb_workers == 0:
+        logging.warning('Not enough memory available to run Tika, the extraction is postponed')
+        return
+
+    manage_tika = CONFIG_PIPELINE['manage_tika_service'] == 'true'
+    if manage_tika:
+        systemctl('start', CONFIG_PIPELINE['tika_service_name'])
+    try:
+        for tika_server_url in CONFIG_TIKA['tika_server_url'].split(','):
+            wait_until_ready(urllib.parse.urljoin(tika_server_url.strip(), '/tika'))
+        extraction.extract(nb_workers=nb_workers)
+    finally:
+        if manage_tika:
+            systemctl('stop', CONFIG_PIPELINE['tika_service_name'])
+
+
+def run_indexation():
+    """run_indexation(): Index the extracted DCEs, and make them searchable at once at the end.
+
+    The periodic refresh of the index is disabled during the indexation, so that searches keep seeing the previous
+    state of the index until the final refresh.
+    """
+
+    es_client = indexation.build_es_client()
+    index_names = [CONFIG_ELASTICSEARCH['index_name']]
+    if CONFIG_ELASTICSEARCH['index_passages'] == 'true':
+        index_names.append(CONFIG_ELASTICSEARCH['passage_index_name'])
+
+    wait_until_ready(CONFIG_ELASTICSEARCH['elasticsearch_server_url'])
+    es_client.indices.put_settings(index=index_names, settings={'index': {'refresh_interval': '-1'}})
+    try:
+        indexation.index()
+    finally:
+        es_client.indices.put_settings(index=index_names, settings={'index': {'refresh_interval': None}})
+        es_client.indices.refresh(index=index_names)
+
+
+def run_streaming():
+    """run_streaming(): Run all the stages concurrently, passing each DCE to the next stage as soon as it is ready.
+
+    The stages are connected by queues of streaming_queue_size annonce ids: a slow stage holds back the previous ones
+    instead of accumulating work in memory. The DCEs left in an intermediate state by a previous run, or whose
+    extraction lease expired, are fed to their next stage while the fetch runs. The wall time is the one of the slowest
+    stage instead of the sum of the stages.
+    """
+
+    client = MongoClient()
+    schema.ensure_indexes(client.place)
+    collection = client.place.dce
+
+    queue_size = int(CONFIG_PIPELINE['streaming_queue_size'])
+    glacier_queue = queue.Queue(maxsize=queue_size)
+    extraction_queue = queue.Queue(maxsize=queue_size)
+    indexation_queue = queue.Queue(maxsize=queue_size)
+
+    nb_extraction_workers = extraction_workers_for_budget()
+    if nb_extraction_workers == 0:
+        logging.warning('Not enough memory available to run Tika, the extraction is postponed')
+    manage_tika = CONFIG_PIPELINE['manage_tika_service'] == 'true' and nb_extraction_workers > 0
+    if manage_tika:
+        systemctl('start', CONFIG_PIPELINE['tika_service_name'])
+    try:
+        tika_server_urls = [url.strip() for url in CONFIG_TIKA['tika_server_url'].split(',')]
+        if nb_extraction_workers > 0:
+            for tika_server_url in tika_server_urls:
+                wait_until_ready(urllib.parse.urljoin(tika_server_url, '/tika'))
+        wait_until_ready(CONFIG_ELASTICSEARCH['elasticsearch_server_url'])
+
+        cache = extraction.build_extraction_cache()
+        s3_client = build_s3_client()
+        transfer_config = build_transfer_config()
+        stages = [
+            Stage(
+                name='glacier',
+                input_queue=glacier_queue,
+                output_queue=extraction_queue,
+                nb_workers=int(CONFIG_PIPELINE['streaming_glacier_workers']),
+                build_process=lambda worker_index: archive_process(collection, s3_client, transfer_config),
+            ),
+            Stage(
+                name='extraction',
+                input_queue=extraction_queue,
+                output_queue=indexation_queue,
+                nb_workers=nb_extraction_workers,
+                build_process=lambda worker_index: extraction_process(
+                    collection, tika_server_urls[worker_index % len(tika_server_urls)], cache),
+            ),
+            Stage(
+                name='indexation',
+                input_queue=indexation_queue,
+                output_queue=None,
+                nb_workers=int(CONFIG_PIPELINE['streaming_indexation_workers']),
+                build_process=lambda worker_index: indexation_process(collection),
+            ),
+        ]
+
+        # Leftovers of the previous runs, listed before feeding the queues so that no cursor is kept open while blocked.
+        # They are fed by their own threads, the fetch does not wait for the backlog to fit in the queues.
+        feeders = []
+        for query, stage_queue in [
+            ({'state': STATE_CONTENT_EXTRACTION_OK}, indexation_queue),
+            (extraction.build_claim_query(datetime.datetime.now()), extraction_queue),
+            ({'state': STATE_FETCH_OK}, glacier_queue),
+        ]:
+            cursor = collection.find(query, {'annonce_id': True, '_id': False}).sort('fetch_datetime', 1)
+            annonce_ids = [dce_data['annonce_id'] for dce_data in cursor]
+            feeders.append(threading.Thread(target=feed_queue, args=(stage_queue, annonce_ids)))
+        for feeder in feeders:
+            feeder.start()
+
+        try:
+            fetch.fetch_new_dce(
+                database=client.place,
+                on_fetched=lambda annonce_data: glacier_queue.put(annonce_data['annonce_id']),
+            )
+        finally:
+            for feeder in feeders:
+                feeder.join()
+            # Each stage is closed once the previous one can no longer feed it
+            for stage in stages:
+                stage.close()
+            # fetch_new_dce() writes the report of the fetch
+            for stage_name in ['glacier', 'extraction', 'indexation', 'pipeline']:
+                metrics.write_report(stage_name)
+    finally:
+        if manage_tika:
+            systemctl('stop', CONFIG_PIPELINE['tika_service_name'])
+        client.close()
+
+
+def feed_queue(stage_queue, annonce_ids):
+    for annonce_id in annonce_ids:
+        stage_queue.put(annonce_id)
+
+
+class Stage:
+    """Stage: Workers taking annonce ids from input_queue, and putting those processed successfully in output_queue
+
+    build_process(worker_index) is called in each worker thread, and returns the function processing an annonce id
+    with the resources of this worker. That function returns True if the DCE is ready for the next stage.
+    With nb_workers = 0, the annonce ids are dropped: the DCEs stay in their state for the next run.
+    """
+
+    def __init__(self, name, input_queue, output_queue, nb_workers, build_process):
+        self.name = name
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        if nb_workers == 0:
+            nb_workers = 1
+            build_process = lambda worker_index: (lambda annonce_id: False)
+        self.build_process = build_process
+        self.threads = [threading.Thread(target=self.work, args=(i,)) for i in range(nb_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def work(self, worker_index):
+        process = self.build_process(worker_index)
+        while True:
+            metrics.observe('pipeline_queue_depth', self.input_queue.qsize(), buckets=metrics.DEPTH_BUCKETS, stage=self.name)
+            annonce_id = self.input_queue.get()
+            if annonce_id is None:
+                break
+            try:
+                with metrics.timer('pipeline_stage_seconds', stage=self.name):
+                    ready = process(annonce_id)
+            except Exception as exception:
+                ready = False
+                metrics.count('pipeline_failures', stage=self.name, exception_type=type(exception).__name__)
+                logging.warning("Exception of type {} in stage {} for annonce {}".format(type(exception).__name__, self.name, annonce_id))
+                logging.debug("Exception details: {}".format(exception))
+                logging.debug(traceback.format_exc())
+            if ready and self.output_queue is not None:
+                self.output_queue.put(annonce_id)
+
+    def close(self):
+        """close(): Wait until the queue is processed and stop the workers
+        """
+        for _ in self.threads:
+            self.input_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def archive_process(collection, s3_client, transfer_config):
+    def process(annonce_id):
+        dce_data = collection.find_one({'annonce_id': annonce_id, 'state': STATE_FETCH_OK}, schema.GLACIER_PROJECTION)
+        if dce_data is None:  # already taken by another run
+            return False
+        glacier.save_dce(dce_data=dce_data, s3_client=s3_client, collection=collection, transfer_config=transfer_config)
+        return collection.count_documents({'annonce_id': annonce_id, 'state': STATE_GLACIER_OK}) > 0
+
+    return process
+
+
+def extraction_process(collection, tika_server_url, cache):
+    s3_resource = build_s3_resource()
+
+    def process(annonce_id):
+        dce_data = extraction.claim_dce(collection, annonce_id=annonce_id)
+        if dce_data is None:  # already claimed by another worker
+            return False
+        extraction.extract_dce(
+            dce_data=dce_data,
+            tika_server_url=tika_server_url,
+            s3_resource=s3_resource,
+            collection=collection,
+            cache=cache,
+        )
+        return collection.count_documents({'annonce_id': annonce_id, 'state': STATE_CONTENT_EXTRACTION_OK}) > 0
+
+    return process
+
+
+def indexation_process(collection):
+    es_client = indexation.build_es_client()
+
+    def process(annonce_id):
+        dce_data = collection.find_one({'annonce_id': annonce_id, 'state': STATE_CONTENT_EXTRACTION_OK}, schema.INDEXATION_PROJECTION)
+        if dce_data is None:
+            return False
+        indexation.index_dce(dce_data=dce_data, es_client=es_client, collection=collection)
+        return True
+
+    return process
+
+
+def extraction_workers_for_budget():
+    """extraction_workers_for_budget(): Number of extraction workers fitting in the memory currently available.
+
+    Tika needs tika_memory_mb to start, and each worker adds extraction_worker_memory_mb (the requests in flight in
+    Tika and the contents buffered by the worker). min_free_memory_mb is kept free for Elasticsearch and the web app.
+    Returns 0 if Tika does not fit.
+    """
+
+    budget = available_memory_mb() - float(CONFIG_PIPELINE['min_free_memory_mb'])
+    if CONFIG_PIPELINE['manage_tika_service'] == 'true':
+        # Tika is not running yet, its memory is not accounted for in the available memory
+        budget -= float(CONFIG_PIPELINE['tika_memory_mb'])
+    if budget < 0:
+        return 0
+
+    nb_workers = int(budget // float(CONFIG_PIPELINE['extraction_worker_memory_mb']))
+    nb_workers = max(1, min(nb_workers, int(CONFIG_TIKA['nb_workers'])))
+    logging.debug('{} MB available for the extraction, using {} workers'.format(int(budget), nb_workers))
+    return nb_workers
+
+
+def available_memory_mb():
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) / 1024
+    raise Exception('MemAvailable not found in /proc/meminfo')
+
+
+def wait_until_ready(url):
+    """wait_until_ready(): Wait until a server answers on url, instead of sleeping for a fixed time after its start.
+    """
+
+    timeout = float(CONFIG_PIPELINE['service_ready_timeout_seconds'])
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            response = requests.get(url, timeout=10)
+            if response.status_code < 500:
+                return
+        except requests.RequestException:
+            pass
+        if time.monotonic() > deadline:
+            raise Exception('{} is not ready after {} seconds'.format(url, timeout))
+        time.sleep(2)
+
+
+def systemctl(action, service_name):
+    subprocess.run(['sudo', 'systemctl', action, service_name], check=True)
+
+
+if __name__ == '__main__':
+    if CONFIG_PIPELINE['streaming'] == 'true':
+        run_streaming()
+    else:
+        run()
@@ -0,0 +1,98 @@
+"""schema: Indexes of the place database and projections of the stages
+
+Use ensure_indexes() at startup: it creates the missing indexes and leaves the existing ones alone, so it can run
+before every run. The stages poll the dce collection by state, read the documents with the projection of their stage.
+"""
+
+import logging
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+
+FILE_TYPES = ['reglement', 'complement', 'avis', 'dce']
+
+ANNONCE_ID_INDEX = IndexModel([('annonce_id', ASCENDING)], name='annonce_id_1', unique=True)
+# Kept while some annonce_id are stored several times, see ensure_indexes()
+NON_UNIQUE_ANNONCE_ID_INDEX = IndexModel([('annonce_id', ASCENDING)], name='annonce_id_1')
+DCE_INDEXES = [
+    # Polls of the stages (state), oldest DCE first (fetch_datetime)
+    IndexModel([('state', ASCENDING), ('fetch_datetime', ASCENDING)], name='state_1_fetch_datetime_1'),
+    # Known DCE to check for changes, see fetch.load_annonce_ids_to_check()
+    IndexModel([('fetch_datetime', ASCENDING)], name='fetch_datetime_1'),
+    # Incremental backups, see metadata.backup()
+    IndexModel([('last_modified', ASCENDING)], name='last_modified_1'),
+]
+CRAWL_INDEXES = [
+    IndexModel([('full_sweep', ASCENDING), ('complete', ASCENDING), ('start_datetime', DESCENDING)], name='full_sweep_1_complete_1_start_datetime_-1'),
+]
+BACKUPS_INDEXES = [
+    IndexModel([('kind', ASCENDING), ('start_datetime', DESCENDING)], name='kind_1_start_datetime_-1'),
+]
+
+# Fields read by each stage
+GLACIER_PROJECTION = ['annonce_id', 'glacier_files'] + [
+    '{}_{}'.format(field, file_type) for field in ['filename', 'sha256'] for file_type in FILE_TYPES
+]
+EXTRACTION_PROJECTION = ['annonce_id'] + [
+    '{}_{}'.format(field, file_type) for field in ['filename', 'sha256'] for file_type in FILE_TYPES
+]
+INDEXATION_PROJECTION = [
+    'annonce_id', 'org_acronym', 'links_boamp', 'reference', 'intitule', 'objet', 'organisme', 'reglement_ref',
+    'fetch_datetime', 'refetched',
+] + [
+    '{}_{}'.format(field, file_type) for field in ['filename', 'file_size', 'embedded_filenames'] for file_type in FILE_TYPES
+]
+
+
+def ensure_indexes(database):
+    """ensure_indexes: Create the indexes of the place database that do not exist yet
+
+    The non-unique annonce_id index created by former setups (see import-to-mongo.ipynb) is replaced by a unique one.
+    If some annonce_id are stored several times, the unique index cannot be built: a non-unique one is kept instead,
+    and the duplicates are logged.
+    """
+
+    ensure_annonce_id_index(database.dce)
+    database.dce.create_indexes(DCE_INDEXES)
+    database.crawl.create_indexes(CRAWL_INDEXES)
+    database.backups.create_indexes(BACKUPS_INDEXES)
+
+
+def ensure_annonce_id_index(collection):
+    """ensure_annonce_id_index: Make the annonce_id index unique if the collection allows it
+    """
+
+    annonce_id_index = collection.index_information().get('annonce_id_1')
+    if annonce_id_index is not None and annonce_id_index.get('unique'):
+        return
+
+    duplicates = find_duplicate_annonce_ids(collection)
+    if duplicates:
+        logging.warning('Some annonce_id are stored several times (for example {}), the annonce_id index is not unique'.format(
+            ', '.join(duplicates)))
+        if annonce_id_index is None:
+            collection.create_indexes([NON_UNIQUE_ANNONCE_ID_INDEX])
+        return
+
+    if annonce_id_index is not None:
+        logging.info('Replacing the annonce_id index by a unique index')
+        collection.drop_index('annonce_id_1')
+    try:
+        collection.create_indexes([ANNONCE_ID_INDEX])
+    except OperationFailure as exception:
+        # A duplicate inserted since the check, the collection must not be left without annonce_id index
+        logging.warning('Exception of type {} while creating the unique annonce_id index'.format(type(exception).__name__))
+        logging.debug('Exception details: {}'.format(exception))
+        collection.create_indexes([NON_UNIQUE_ANNONCE_ID_INDEX])
+
+
+def find_duplicate_annonce_ids(collection, limit=5):
+    """find_duplicate_annonce_ids: Return up to limit annonce_id stored in several documents
+    """
+    cursor = collection.aggregate([
+        {'$group': {'_id': '$annonce_id', 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$limit': limit},
+    ], allowDiskUse=True)
+    return [str(result['_id']) for result in cursor]
@@ -0,0 +1,47 @@
+"""throttle: Limit the number of concurrent requests sent to each host
+
+Use HostThrottle.slot(url) around every request sent to a remote host.
+"""
+
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+
+
+class HostThrottle:
+    """HostThrottle: Bound the number of concurrent requests per host and space them out.
+
+    max_per_host: maximum number of requests in flight at the same time for a given host
+    min_interval: minimum delay (in seconds) between the start of two requests to the same host
+    """
+
+    def __init__(self, max_per_host, min_interval):
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_start = {}
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._semaphores[host]
+
+    def _wait_turn(self, host):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self.min_interval
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+
+    @contextmanager
+    def slot(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        semaphore = self._semaphore(host)
+        with semaphore:
+            self._wait_turn(host)
+            yield
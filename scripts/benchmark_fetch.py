@@ -0,0 +1,266 @@
+"""Measure the throughput of fetch_new_dce() against a local stand-in of PLACE, without touching the live site.
+
+The stand-in server emulates the PRADO flows used by fetch.py: the listing (init() and next_page()), the annonce pages
+and the avis/reglement/complement downloads, and the three-step DCE download. It sends page states, Set-Cookie and
+Content-Disposition headers like PLACE, with a configurable latency and file sizes. The downloads accept Range requests,
+and --drop-rate cuts some of them halfway to exercise their resumption.
+
+A mongo server is needed, the benchmark uses (and drops) a scratch database. Example:
+
+    python scripts/benchmark_fetch.py --annonces 500 --latency 0.05 --max-workers 16
+"""
+
+import argparse
+import base64
+import http.server
+import math
+import os
+import random
+import re
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+from pymongo import MongoClient
+
+from scraper_place.config import CONFIG_FETCH, CONFIG_FILE_STORAGE
+from scraper_place.fetch import fetch_new_dce
+from scraper_place.fetch_client import FetchClient
+
+
+PAGE_SIZE = 20
+ORG_ACRONYM = 'a1b2'
+PAGE_STATE_FILLER = base64.b64encode(os.urandom(75000)).decode()  # ~100kB, like PLACE
+
+
+def page_state(kind, number):
+    # The page state carries the position in the flow, followed by a large opaque filler
+    return '{}{}Z{}'.format(kind, number, PAGE_STATE_FILLER)
+
+
+def parse_page_state(value):
+    kind = value[0]
+    number = int(value[1:value.index('Z')])
+    return kind, number
+
+
+def annonce_id(index):
+    return str(100000 + index)
+
+
+def build_form_page(state):
+    return '<html><body><form><input type="hidden" name="PRADO_PAGESTATE" id="PRADO_PAGESTATE" value="{}"/>'.format(state)
+
+
+def build_listing_page(number, nb_annonces):
+    """build_listing_page(): Page number of the results of the stand-in, also used by benchmark_parsing.py"""
+    first = (number - 1) * PAGE_SIZE
+    last = min(number * PAGE_SIZE, nb_annonces)
+    rows = ''.join(
+        '<tr><td><a href="https://www.marches-publics.gouv.fr/app.php/entreprise/consultation/{}?orgAcronyme={}">'
+        'Consultation {}</a></td></tr>'.format(annonce_id(index), ORG_ACRONYM, index)
+        for index in range(first, last)
+    )
+    return build_form_page(page_state('L', number)) + '<table>{}</table></form></body></html>'.format(rows)
+
+
+def build_annonce_page(consultation_id):
+    """build_annonce_page(): Annonce page of the stand-in, also used by benchmark_parsing.py"""
+    recap = ''.join(
+        '<div class="col-md-10 text-justify"><label>{} :</label><div><span>{} {}</span></div></div>'.format(
+            label, label, consultation_id)
+        for label in ['Référence', 'Intitulé', 'Objet', 'Organisme']
+    )
+    download = '/index.php?page=Entreprise.{}&amp;id={}&amp;orgAcronyme={}'
+    links = (
+        '<a id="linkDownloadAvis" href="{}">Avis</a>'.format(download.format('EntrepriseDownloadAvis', consultation_id, ORG_ACRONYM)) +
+        '<a id="linkDownloadReglement" href="{}">RC</a>'.format(download.format('EntrepriseDownloadReglement', 'UkM' + consultation_id + '=', ORG_ACRONYM)) +
+        '<a id="linkDownloadComplement" href="{}">Complement</a>'.format(download.format('EntrepriseDownloadComplement', consultation_id, ORG_ACRONYM)) +
+        '<a id="linkDownloadDce" href="{}">DCE</a>'.format(download.format('EntrepriseDemandeTelechargementDce', consultation_id, ORG_ACRONYM)) +
+        '<a href="http://www.boamp.fr/avis/detail/22-{}">BOAMP</a>'.format(consultation_id)
+    )
+    return '<html><body>{}<div id="pub">{}</div></body></html>'.format(recap, links)
+
+
+class PlaceStandIn(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, nb_annonces, latency, file_size, dce_size, drop_rate=0):
+        super().__init__(('127.0.0.1', 0), PlaceHandler)
+        self.nb_annonces = nb_annonces
+        self.nb_pages = math.ceil(nb_annonces / PAGE_SIZE)
+        self.latency = latency
+        self.file_size = file_size
+        self.dce_size = dce_size
+        self.drop_rate = drop_rate
+        self.lock = threading.Lock()
+        self.nb_listing_pages = 0
+        self.nb_requests = 0
+        self.nb_dropped = 0
+        self.bytes_sent = 0
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def count(self, nb_bytes, listing_page=False):
+        with self.lock:
+            self.nb_requests += 1
+            self.bytes_sent += nb_bytes
+            if listing_page:
+                self.nb_listing_pages += 1
+
+
+class PlaceHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        page = query.get('page', [None])[0]
+
+        if url.path == '/' and page == 'Entreprise.EntrepriseAdvancedSearch':
+            self.send_html(build_form_page(page_state('S', 0)), set_cookie=True)
+        elif url.path.startswith('/app.php/entreprise/consultation/'):
+            self.send_html(build_annonce_page(url.path.rsplit('/', 1)[1]))
+        elif page == 'Entreprise.EntrepriseDownloadAvis':
+            self.send_file(self.server.file_size, 'text/html', 'attachment; filename=avis.html;')
+        elif page == 'Entreprise.EntrepriseDownloadReglement':
+            self.send_file(self.server.file_size, 'application/octet-stream', 'attachment; filename="reglement.pdf";')
+        elif page == 'Entreprise.EntrepriseDownloadComplement':
+            self.send_file(self.server.file_size, 'application/pdf', 'attachment; filename="complement.pdf"')
+        elif page == 'Entreprise.EntrepriseDemandeTelechargementDce':
+            self.send_html(build_form_page(page_state('D', 0)), set_cookie=True)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        length = int(self.headers['Content-Length'])
+        data = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        if 'PHPSESSID' not in self.headers.get('Cookie', ''):
+            self.send_error(403)
+            return
+
+        kind, number = parse_page_state(data['PRADO_PAGESTATE'][0])
+        target = data['PRADO_POSTBACK_TARGET'][0]
+
+        if kind in 'SL' and target.endswith('listePageSizeTop'):
+            self.send_listing_page(1)
+        elif kind == 'L' and target.endswith('PagerTop$ctl2'):
+            if number >= self.server.nb_pages:
+                self.send_error(500)
+            else:
+                self.send_listing_page(number + 1)
+        elif kind == 'D' and target.endswith('validateButton'):
+            self.send_html(build_form_page(page_state('D', 1)))
+        elif kind == 'D' and target.endswith('completeDownload'):
+            self.send_file(self.server.dce_size, 'application/zip', 'attachment; filename="dce.zip";')
+        else:
+            self.send_error(400)
+
+    def send_listing_page(self, number):
+        self.send_html(build_listing_page(number, self.server.nb_annonces), listing_page=True)
+
+    def send_html(self, html, set_cookie=False, listing_page=False):
+        body = html.encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        if set_cookie:
+            self.send_header('Set-Cookie', 'PHPSESSID={}; path=/'.format(os.urandom(8).hex()))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(len(body), listing_page=listing_page)
+
+    def send_file(self, size, content_type, content_disposition):
+        start = 0
+        match = re.match(r'^bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range') in (None, '"{}"'.format(size)):
+            start = int(match.groups()[0])
+            if start >= size:
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Disposition', content_disposition)
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('ETag', '"{}"'.format(size))
+        self.end_headers()
+
+        end = size
+        if random.random() < self.server.drop_rate:
+            end = start + (size - start) // 2
+            self.close_connection = True
+            with self.server.lock:
+                self.server.nb_dropped += 1
+        chunk = b'x' * 65536
+        remaining = end - start
+        while remaining > 0:
+            self.wfile.write(chunk[:remaining])
+            remaining -= len(chunk)
+        self.server.count(end - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--annonces', type=int, default=200, help='number of annonces listed by the stand-in')
+    parser.add_argument('--latency', type=float, default=0.05, help='delay in seconds before each response')
+    parser.add_argument('--file-size', type=int, default=200000, help='size in bytes of the avis, reglement and complement')
+    parser.add_argument('--dce-size', type=int, default=2000000, help='size in bytes of the DCE archive')
+    parser.add_argument('--drop-rate', type=float, default=0, help='share of the downloads cut halfway')
+    parser.add_argument('--max-workers', help='overrides [fetch] max_workers')
+    parser.add_argument('--max-workers-per-host', help='overrides [fetch] max_workers_per_host')
+    parser.add_argument('--min-request-interval', help='overrides [fetch] min_request_interval')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--database', default='place_benchmark', help='scratch database, dropped before and after the run')
+    args = parser.parse_args()
+
+    for option in ['max_workers', 'max_workers_per_host', 'min_request_interval']:
+        if getattr(args, option) is not None:
+            CONFIG_FETCH[option] = getattr(args, option)
+
+    server = PlaceStandIn(nb_annonces=args.annonces, latency=args.latency, file_size=args.file_size, dce_size=args.dce_size, drop_rate=args.drop_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    mongo_client = MongoClient(args.mongo_uri)
+    mongo_client.drop_database(args.database)
+    fetch_client = FetchClient(base_url=server.base_url)
+
+    with tempfile.TemporaryDirectory() as public_directory:
+        CONFIG_FILE_STORAGE['public_directory'] = public_directory
+        CONFIG_FILE_STORAGE['crawl_checkpoint_path'] = os.path.join(public_directory, 'crawl_checkpoint.json')
+        CONFIG_FILE_STORAGE['blob_directory'] = os.path.join(public_directory, 'blobs')
+        os.mkdir(CONFIG_FILE_STORAGE['blob_directory'])
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        nb_processed = fetch_new_dce(nb_pages=0, fetch_client=fetch_client, database=mongo_client[args.database])
+        elapsed = time.perf_counter() - start
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    fetch_client.close()
+    mongo_client.drop_database(args.database)
+    mongo_client.close()
+    server.shutdown()
+
+    print('annonces stored: {} / {}'.format(nb_processed, args.annonces))
+    print('downloads cut: {}'.format(server.nb_dropped))
+    print('elapsed: {:.2f} s'.format(elapsed))
+    print('listing pages/s: {:.2f}'.format(server.nb_listing_pages / elapsed))
+    print('annonces/s: {:.2f}'.format(nb_processed / elapsed))
+    print('requests/s: {:.2f}'.format(server.nb_requests / elapsed))
+    print('MB/s: {:.2f}'.format(server.bytes_sent / elapsed / 1e6))
+    print('peak python memory: {:.1f} MB'.format(peak_traced / 1e6))
+    print('peak RSS: {:.1f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3))
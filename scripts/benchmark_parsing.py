@@ -0,0 +1,96 @@
+"""Compare the HTML parsing of fetch.py with the former html.parser implementation.
+
+By default, the pages are built by the stand-in of PLACE of benchmark_fetch.py, so that the benchmark runs offline:
+
+    python scripts/benchmark_parsing.py
+
+The pages of PLACE itself are larger and less regular. Save a page of results and an annonce page once (for example
+"Save page as..., HTML only" in a browser), then run:
+
+    python scripts/benchmark_parsing.py --listing listing.html --annonce annonce.html
+
+Both parsers must find the same listing links, recap fields and #pub links, lxml repairs malformed HTML differently.
+"""
+
+import argparse
+import timeit
+
+from bs4 import BeautifulSoup
+
+from benchmark_fetch import build_annonce_page, build_listing_page
+from scraper_place.fetch import BOAMP_REGEX, HTML_PARSER, LINK_REGEX, extract_links, filter_links
+
+
+class SavedResponse:
+    """Stand-in for requests.Response, extract_links() only reads .text"""
+    def __init__(self, text):
+        self.text = text
+
+
+def former_extract_links(page, regex):
+    soup = BeautifulSoup(page, 'html.parser')
+    links = soup.find_all('a')
+    hrefs = [link.attrs['href'] for link in links if 'href' in link.attrs]
+    return [href for href in hrefs if regex.match(href)]
+
+
+def former_parse_annonce(page):
+    # fetch_data() used to parse the annonce page twice
+    former_extract_links(page, BOAMP_REGEX)
+    soup = BeautifulSoup(page, 'html.parser')
+    return soup.find_all(class_="col-md-10 text-justify"), soup.find_all(id='pub')
+
+
+def parse_annonce(page):
+    soup = BeautifulSoup(page, HTML_PARSER)
+    filter_links(soup.find_all('a'), BOAMP_REGEX)
+    return soup.find_all(class_="col-md-10 text-justify"), soup.find_all(id='pub')
+
+
+def annonce_fields(parsed_annonce):
+    """annonce_fields(): What fetch_annonce_page() reads from the recap fields and the #pub links"""
+    recap_data, publicite_tabs = parsed_annonce
+    recap = [(recap.find('label').text.strip(), recap.find('div').find('span').text.strip()) for recap in recap_data]
+    links = [(link.attrs.get('id'), link.attrs.get('href')) for tab in publicite_tabs for link in tab.find_all('a')]
+    return recap, links
+
+
+def report(name, former, current, number):
+    former_time = timeit.timeit(former, number=number) / number
+    current_time = timeit.timeit(current, number=number) / number
+    print('{}: former {:.1f} ms, current {:.1f} ms, speedup x{:.1f}'.format(
+        name, former_time * 1000, current_time * 1000, former_time / current_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--listing', help='saved page of results, a page of the stand-in if not set')
+    parser.add_argument('--annonce', help='saved annonce page, a page of the stand-in if not set')
+    parser.add_argument('--number', type=int, default=20, help='number of runs of each parser')
+    args = parser.parse_args()
+
+    if args.listing:
+        with open(args.listing, 'r', encoding='UTF-8') as f:
+            listing = f.read()
+    else:
+        listing = build_listing_page(1, nb_annonces=20)
+    assert former_extract_links(listing, LINK_REGEX) == extract_links(SavedResponse(listing), LINK_REGEX)
+    report(
+        'listing page',
+        lambda: former_extract_links(listing, LINK_REGEX),
+        lambda: extract_links(SavedResponse(listing), LINK_REGEX),
+        args.number,
+    )
+
+    if args.annonce:
+        with open(args.annonce, 'r', encoding='UTF-8') as f:
+            annonce = f.read()
+    else:
+        annonce = build_annonce_page('100000')
+    assert annonce_fields(former_parse_annonce(annonce)) == annonce_fields(parse_annonce(annonce))
+    report(
+        'annonce page',
+        lambda: former_parse_annonce(annonce),
+        lambda: parse_annonce(annonce),
+        args.number,
+    )
@@ -0,0 +1,142 @@
+"""Measure the cost of the state polls of the stages on a large dce collection, with and without the indexes of schema.py.
+
+The scratch collection is filled with synthetic DCE, most of them already indexed and a few waiting in each stage, like
+the place database after some years of nightly runs. The polls of the stages (the leftovers listed by glacier.save()
+and run_streaming(), the claim of extraction.claim_dce(), the cursor of indexation.index()) are timed and explained
+before and after ensure_indexes(), and the size of the documents read is compared with the projections of the stages.
+
+A mongo server is needed, the benchmark uses (and drops) a scratch database. Example:
+
+    python scripts/benchmark_schema.py --documents 200000 --pending 500
+"""
+
+import argparse
+import datetime
+import random
+import statistics
+import time
+
+import bson
+from pymongo import MongoClient
+
+from scraper_place.config import STATE_CONTENT_EXTRACTING, STATE_CONTENT_EXTRACTION_OK, STATE_CONTENT_INDEXATION_OK, STATE_FETCH_OK, STATE_GLACIER_OK
+from scraper_place.extraction import build_claim_query
+from scraper_place.schema import EXTRACTION_PROJECTION, FILE_TYPES, GLACIER_PROJECTION, INDEXATION_PROJECTION, ensure_indexes
+
+
+INSERT_BATCH_SIZE = 5000
+
+
+def build_dce_data(index, state, nb_embedded_filenames):
+    fetch_datetime = datetime.datetime(2019, 1, 1) + datetime.timedelta(minutes=index)
+    dce_data = {
+        'annonce_id': str(100000 + index),
+        'org_acronym': 'a1b2',
+        'links_boamp': ['http://www.boamp.fr/avis/detail/{}'.format(index)],
+        'reference': 'REF-{}'.format(index),
+        'intitule': 'Intitulé de la consultation {}'.format(index),
+        'objet': 'Objet de la consultation {} '.format(index) * 10,
+        'organisme': 'Organisme {}'.format(index % 1000),
+        'reglement_ref': 'RC-{}'.format(index),
+        'fetch_datetime': fetch_datetime,
+        'last_modified': fetch_datetime,
+        'state': state,
+        'fingerprint': '{:064x}'.format(index),
+    }
+    for file_type in FILE_TYPES:
+        dce_data['filename_{}'.format(file_type)] = '{}_{}.pdf'.format(file_type, index)
+        dce_data['file_size_{}'.format(file_type)] = 100000
+        dce_data['sha256_{}'.format(file_type)] = '{:064x}'.format(index * 4 + FILE_TYPES.index(file_type))
+        dce_data['embedded_filenames_{}'.format(file_type)] = [
+            'piece_{}/document_{}.pdf'.format(index, position) for position in range(nb_embedded_filenames)
+        ]
+    if state == STATE_CONTENT_EXTRACTING:
+        dce_data['extraction_start_datetime'] = fetch_datetime
+    return dce_data
+
+
+def fill_collection(collection, nb_documents, nb_pending, nb_embedded_filenames):
+    pending_states = [STATE_FETCH_OK, STATE_GLACIER_OK, STATE_CONTENT_EXTRACTING, STATE_CONTENT_EXTRACTION_OK]
+    pending_indexes = set(random.sample(range(nb_documents), nb_pending * len(pending_states)))
+    pending_states = iter(pending_states * nb_pending)
+
+    batch = []
+    for index in range(nb_documents):
+        state = next(pending_states) if index in pending_indexes else STATE_CONTENT_INDEXATION_OK
+        batch.append(build_dce_data(index, state, nb_embedded_filenames))
+        if len(batch) >= INSERT_BATCH_SIZE:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def build_polls(collection):
+    """build_polls(): The queries of the stages, as functions returning a cursor"""
+    claim_query = build_claim_query(datetime.datetime.now())
+    return [
+        ('leftovers fetch_ok', lambda: collection.find({'state': STATE_FETCH_OK}, {'annonce_id': True, '_id': False}).sort('fetch_datetime', 1)),
+        ('extraction claim', lambda: collection.find(claim_query, EXTRACTION_PROJECTION).sort('fetch_datetime', 1).limit(1)),
+        ('indexation cursor', lambda: collection.find({'state': STATE_CONTENT_EXTRACTION_OK}, INDEXATION_PROJECTION)),
+    ]
+
+
+def measure_polls(collection, nb_repeats):
+    results = []
+    for name, build_cursor in build_polls(collection):
+        durations = []
+        for _ in range(nb_repeats):
+            start = time.perf_counter()
+            nb_returned = len(list(build_cursor()))
+            durations.append(time.perf_counter() - start)
+        execution_stats = build_cursor().explain().get('executionStats', {})
+        results.append((name, nb_returned, statistics.median(durations), execution_stats.get('totalKeysExamined', '-'), execution_stats.get('totalDocsExamined', '-')))
+    return results
+
+
+def print_polls(title, results):
+    print(title)
+    print('  {:<20} {:>8} {:>12} {:>12} {:>12}'.format('poll', 'returned', 'median ms', 'keys', 'docs'))
+    for name, nb_returned, duration, nb_keys, nb_docs in results:
+        print('  {:<20} {:>8} {:>12.2f} {:>12} {:>12}'.format(name, nb_returned, duration * 1000, nb_keys, nb_docs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=100000, help='number of DCE in the scratch collection')
+    parser.add_argument('--pending', type=int, default=200, help='number of DCE waiting in each stage')
+    parser.add_argument('--embedded-filenames', type=int, default=50, help='number of files listed in each archive')
+    parser.add_argument('--repeats', type=int, default=5, help='number of runs of each poll, the median is reported')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--database', default='place_benchmark', help='scratch database, dropped before and after the run')
+    args = parser.parse_args()
+
+    mongo_client = MongoClient(args.mongo_uri)
+    mongo_client.drop_database(args.database)
+    database = mongo_client[args.database]
+    collection = database.dce
+
+    start = time.perf_counter()
+    fill_collection(collection, args.documents, args.pending, args.embedded_filenames)
+    print('inserted {} DCE in {:.1f} s'.format(collection.estimated_document_count(), time.perf_counter() - start))
+
+    print_polls('without indexes', measure_polls(collection, args.repeats))
+
+    start = time.perf_counter()
+    ensure_indexes(database)
+    print('ensure_indexes: {:.2f} s'.format(time.perf_counter() - start))
+    start = time.perf_counter()
+    ensure_indexes(database)
+    print('ensure_indexes again: {:.3f} s, indexes: {}'.format(time.perf_counter() - start, ', '.join(sorted(collection.index_information()))))
+
+    print_polls('with indexes', measure_polls(collection, args.repeats))
+
+    print('document size read by the stages (bytes)')
+    dce_data = collection.find_one({'state': STATE_CONTENT_INDEXATION_OK})
+    print('  {:<20} {:>8}'.format('full document', len(bson.encode(dce_data))))
+    for name, projection in [('glacier', GLACIER_PROJECTION), ('extraction', EXTRACTION_PROJECTION), ('indexation', INDEXATION_PROJECTION)]:
+        projected_data = collection.find_one({'_id': dce_data['_id']}, projection)
+        print('  {:<20} {:>8}'.format(name, len(bson.encode(projected_data))))
+
+    mongo_client.drop_database(args.database)
+    mongo_client.close()
@@ -4,17 +4,7 @@ set -o errexit
 
 PYTHON_PATH=/home/debian/.local/share/virtualenvs/place/bin/python
 SCRAPER_PLACE_PATH=/srv/scraper-place/scraper_place
-$PYTHON_PATH $SCRAPER_PLACE_PATH/fetch.py
-$PYTHON_PATH $SCRAPER_PLACE_PATH/glacier.py
-touch /srv/scraper-place/maintenance.lock
-sudo systemctl stop betterplace.service
-sudo systemctl stop elasticsearch.service
-sudo systemctl start tika.service
-sleep 60
-$PYTHON_PATH $SCRAPER_PLACE_PATH/extraction.py
-sudo systemctl stop tika.service
-sudo systemctl start elasticsearch.service
-sleep 60
-$PYTHON_PATH $SCRAPER_PLACE_PATH/indexation.py
-sudo systemctl start betterplace.service
-rm /srv/scraper-place/maintenance.lock
+# Elasticsearch and betterplace.service keep running, see scraper_place/pipeline.py
+$PYTHON_PATH $SCRAPER_PLACE_PATH/pipeline.py
+# Incremental metadata backup, with a full snapshot every [backup] full_snapshot_interval_days
+$PYTHON_PATH $SCRAPER_PLACE_PATH/../scripts/backup_metadata.py
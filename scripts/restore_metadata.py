@@ -0,0 +1,27 @@
+"""Restore the place.dce collection from the metadata bucket: the last full snapshot, then the incremental backups.
+
+Restore into an empty collection, for example:
+
+    python scripts/restore_metadata.py --database place_restored
+"""
+
+import argparse
+import logging
+
+from pymongo import MongoClient
+
+from scraper_place.metadata import restore
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--database', default='place')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    collection = MongoClient(args.mongo_uri)[args.database].dce
+    if collection.estimated_document_count():
+        raise Exception('{}.dce is not empty'.format(args.database))
+
+    restore(collection)
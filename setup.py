@@ -13,7 +13,9 @@ setup(
         'beautifulsoup4>=4.11.1',
         'boto3>=1.24.66',
         'elasticsearch>=8.4.0',
+        'ijson>=3.1.4',
         'jupyter>=1.0.0',
+        'lxml>=4.9.1',
         'matplotlib>=2.1.2',
         'pymongo>=4.2.0',
         'requests>=2.28.1',